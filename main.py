@@ -11,16 +11,23 @@ SBALO Promo Bot — Render (webhook с fallback на polling)
 - Фиксация источника из /start-параметра (или "direct" при клике «Подписаться»)
 """
 
-import os, random, string, calendar, threading
+import os, io, re, sys, html, json, zlib, random, string, calendar, sqlite3, threading, functools, contextlib
+import cProfile, pstats
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from queue import Queue
 from threading import Timer
-from time import sleep
-from datetime import datetime
+from time import sleep, monotonic
+from datetime import datetime, timedelta
 from typing import Dict, Set, List, Tuple, Optional
 
 import telebot
 from flask import Flask, request
 
 import gspread
+from gspread.utils import rowcol_to_a1
 from oauth2client.service_account import ServiceAccountCredentials
 
 # ---------- ENV ----------
@@ -38,6 +45,48 @@ SUBSCRIPTION_MIN_DAYS = int(os.getenv("SUBSCRIPTION_MIN_DAYS", "0"))
 SERVICE_ACCOUNT_JSON = os.getenv("SERVICE_ACCOUNT_JSON", "").strip()
 DISCOUNT_LABEL = os.getenv("DISCOUNT_LABEL", "5%")  # скидка по умолчанию
 
+# Обработка апдейтов: воркеры (параллельно между пользователями, по порядку внутри пользователя)
+DISPATCH_WORKERS = max(1, int(os.getenv("DISPATCH_WORKERS", "8")))
+POLL_LIMIT = min(100, max(1, int(os.getenv("POLL_LIMIT", "100"))))
+POLL_TIMEOUT = int(os.getenv("POLL_TIMEOUT", "50"))  # long polling getUpdates, сек
+
+# Потоки для тяжёлой части колбэков (статистика, выдача кода) после мгновенного ответа Telegram
+BG_WORKERS = int(os.getenv("BG_WORKERS", "4"))
+
+# Кэш статуса членства в канале (секунды): «подписан» живёт дольше, «не подписан» — коротко
+MEMBER_CACHE_TTL_POS = int(os.getenv("MEMBER_CACHE_TTL_POS", "300"))
+MEMBER_CACHE_TTL_NEG = int(os.getenv("MEMBER_CACHE_TTL_NEG", "15"))
+MEMBER_CACHE_MAX = int(os.getenv("MEMBER_CACHE_MAX", "20000"))
+
+# Архив: закрытые строки (погашен код или отписка) старше N дней уезжают в листы «Archive YYYY-MM»
+ARCHIVE_AFTER_DAYS = int(os.getenv("ARCHIVE_AFTER_DAYS", "90"))
+ARCHIVE_INTERVAL_HOURS = float(os.getenv("ARCHIVE_INTERVAL_HOURS", "0"))  # 0 — только вручную (/archive_run)
+ARCHIVE_INDEX_PATH = os.getenv("ARCHIVE_INDEX_PATH", "/tmp/archive_index.json")
+
+# Сверка зеркала с таблицей после ручных правок: период опроса в секундах (0 — только /resync)
+RESYNC_INTERVAL_SEC = int(os.getenv("RESYNC_INTERVAL_SEC", "60"))
+# Если файл меняли только записи бота, лист не читается, но не дольше стольких секунд подряд
+RESYNC_FULL_CHECK_SEC = int(os.getenv("RESYNC_FULL_CHECK_SEC", "900"))
+
+# Отзывы: сначала в локальный журнал (append-only), потом пачками в лист Feedback
+FEEDBACK_JOURNAL_PATH = os.getenv("FEEDBACK_JOURNAL_PATH", "/tmp/feedback_journal.jsonl")
+FEEDBACK_STATS_PATH = os.getenv("FEEDBACK_STATS_PATH", "/tmp/feedback_stats.json")
+FEEDBACK_FLUSH_SEC = max(1, int(os.getenv("FEEDBACK_FLUSH_SEC", "5")))
+FEEDBACK_FLUSH_BATCH = max(1, int(os.getenv("FEEDBACK_FLUSH_BATCH", "200")))
+
+# /profile: вызов дольше стольких мс попадает в список медленных с разбивкой по времени
+PROFILE_SLOW_MS = int(os.getenv("PROFILE_SLOW_MS", "1000"))
+
+# Несколько воркеров (gunicorn -w N) на одной машине: общий файл SQLite для состояния диалогов,
+# сотрудников и журнала изменений зеркала + файловые блокировки рядом с ним. Пусто — один процесс.
+COORD_DB_PATH = os.getenv("COORD_DB_PATH", "").strip()
+
+# Формат новых промокодов: тело из CODE_ALPHABET (без похожих 0/O, 1/I) + контрольный символ
+CODE_ALPHABET = "".join(dict.fromkeys(os.getenv("CODE_ALPHABET", "23456789ABCDEFGHJKLMNPQRSTUVWXYZ").strip().upper()))
+CODE_BODY_LEN = max(4, int(os.getenv("CODE_BODY_LEN", "5")))
+if len(CODE_ALPHABET) < 10:
+    raise SystemExit("CODE_ALPHABET слишком короткий — нужно хотя бы 10 символов.")
+
 if not SERVICE_ACCOUNT_JSON:
     raise SystemExit("ENV SERVICE_ACCOUNT_JSON пуст — вставьте содержимое credentials.json в переменную окружения.")
 
@@ -47,6 +96,155 @@ missing = [k for k, v in [("BOT_TOKEN", BOT_TOKEN),
 if missing:
     raise SystemExit("Нет переменных окружения: " + ", ".join(missing))
 
+# ---------- Координация воркеров ----------
+# Без COORD_DB_PATH всё как раньше: обычные dict/set и threading-lock.
+# С ним состояние диалогов и STAFF_IDS живут в таблице kv, а lock'и — это flock на файлах
+# COORD_DB_PATH.<имя>.lock (плюс RLock внутри процесса), поэтому держат и потоки, и соседние воркеры.
+if COORD_DB_PATH:
+    try:
+        import fcntl
+    except ImportError:
+        raise SystemExit("COORD_DB_PATH поддерживается только на Linux/macOS (нужен fcntl).")
+
+_COORD_LOCAL = threading.local()
+
+def coord_db() -> sqlite3.Connection:
+    conn = getattr(_COORD_LOCAL, "conn", None)
+    if conn is None:
+        conn = sqlite3.connect(COORD_DB_PATH, timeout=30, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        _COORD_LOCAL.conn = conn
+    return conn
+
+class SharedDict:
+    """Словарь user_id -> JSON-значение в таблице kv (пространство имён ns). Видят все воркеры."""
+
+    def __init__(self, ns: str):
+        self.ns = ns
+
+    def get(self, key, default=None):
+        row = coord_db().execute("SELECT v FROM kv WHERE ns=? AND k=?", (self.ns, str(key))).fetchone()
+        return json.loads(row[0]) if row else default
+
+    def __getitem__(self, key):
+        row = coord_db().execute("SELECT v FROM kv WHERE ns=? AND k=?", (self.ns, str(key))).fetchone()
+        if row is None:
+            raise KeyError(key)
+        return json.loads(row[0])
+
+    def __setitem__(self, key, value) -> None:
+        coord_db().execute("INSERT OR REPLACE INTO kv (ns, k, v) VALUES (?, ?, ?)",
+                           (self.ns, str(key), json.dumps(value, ensure_ascii=False)))
+
+    def __contains__(self, key) -> bool:
+        return coord_db().execute("SELECT 1 FROM kv WHERE ns=? AND k=?", (self.ns, str(key))).fetchone() is not None
+
+    def pop(self, key, default=None):
+        # DELETE ... RETURNING есть только в SQLite 3.35+, поэтому читаем и удаляем в одной транзакции
+        conn = coord_db()
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute("SELECT v FROM kv WHERE ns=? AND k=?", (self.ns, str(key))).fetchone()
+            conn.execute("DELETE FROM kv WHERE ns=? AND k=?", (self.ns, str(key)))
+        return json.loads(row[0]) if row else default
+
+class SharedIntSet(SharedDict):
+    """Множество int поверх kv — для STAFF_IDS."""
+
+    def add(self, value: int) -> None:
+        self[value] = 1
+
+    def __iter__(self):
+        rows = coord_db().execute("SELECT k FROM kv WHERE ns=?", (self.ns,)).fetchall()
+        return iter([int(r[0]) for r in rows])
+
+class CoordLock:
+    """Реентерабельный lock на процесс + flock на файл — держит и соседние воркеры.
+    on_acquire вызывается при первом (внешнем) захвате — например, чтобы догнать чужие записи."""
+
+    def __init__(self, name: str, on_acquire=None):
+        self.local = threading.RLock()
+        self.depth = 0
+        self.fd = os.open(f"{COORD_DB_PATH}.{name}.lock", os.O_RDWR | os.O_CREAT, 0o644)
+        self.on_acquire = on_acquire
+
+    def acquire(self, blocking: bool = True) -> bool:
+        if not self.local.acquire(blocking):
+            return False
+        self.depth += 1
+        if self.depth == 1:
+            try:
+                fcntl.flock(self.fd, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                self.depth -= 1
+                self.local.release()
+                return False
+            try:
+                if self.on_acquire:
+                    self.on_acquire()
+            except BaseException:
+                self.release()
+                raise
+        return True
+
+    def release(self) -> None:
+        self.depth -= 1
+        if self.depth == 0:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+        self.local.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+def shared_dict(ns: str) -> dict:
+    return SharedDict(ns) if COORD_DB_PATH else {}
+
+def process_lock(name: str, reentrant: bool = False, on_acquire=None):
+    if COORD_DB_PATH:
+        return CoordLock(name, on_acquire)
+    return threading.RLock() if reentrant else threading.Lock()
+
+LEADER_LOCK = process_lock("leader")
+
+# Апдейты одного пользователя под gunicorn приходят в разные воркеры (альбом фото — почти одновременно),
+# а обработчики делают get → изменить → записать для STATE/FEEDBACK_DRAFT. Поэтому обработка апдейта
+# идёт под межпроцессным lock пользователя: полосы по user_id % COORD_USER_STRIPES, чтобы не плодить файлы.
+COORD_USER_STRIPES = 64
+_USER_LOCKS: Dict[int, "CoordLock"] = {}
+_USER_LOCKS_GUARD = threading.Lock()
+
+def user_lock(user_id: Optional[int]):
+    # в одном процессе порядок по пользователю и так держит UpdateDispatcher
+    if not COORD_DB_PATH or user_id is None:
+        return contextlib.nullcontext()
+    k = user_id % COORD_USER_STRIPES
+    with _USER_LOCKS_GUARD:
+        if k not in _USER_LOCKS:
+            _USER_LOCKS[k] = CoordLock(f"user{k}")
+        return _USER_LOCKS[k]
+
+def coord_is_leader() -> bool:
+    """Один воркер из всех держит этот lock до конца жизни и крутит разовые фоновые задачи."""
+    if not COORD_DB_PATH:
+        return True
+    return LEADER_LOCK.depth > 0 or LEADER_LOCK.acquire(blocking=False)
+
+if COORD_DB_PATH:
+    with process_lock("init"):
+        db = coord_db()
+        db.execute("CREATE TABLE IF NOT EXISTS kv (ns TEXT NOT NULL, k TEXT NOT NULL, v TEXT NOT NULL, PRIMARY KEY (ns, k))")
+        db.execute("CREATE TABLE IF NOT EXISTS changes (seq INTEGER PRIMARY KEY AUTOINCREMENT, "
+                   "pid INTEGER NOT NULL, kind TEXT NOT NULL, payload TEXT NOT NULL)")
+    _staff = SharedIntSet("staff")
+    for _uid in STAFF_IDS:
+        _staff.add(_uid)
+    STAFF_IDS = _staff
+
 # ---------- Google Sheets ----------
 CREDENTIALS_PATH = "/tmp/credentials.json"
 with open(CREDENTIALS_PATH, "w", encoding="utf-8") as f:
@@ -56,8 +254,8 @@ SCOPES = ["https://spreadsheets.google.com/feeds", "https://www.googleapis.com/a
 creds = ServiceAccountCredentials.from_json_keyfile_name(CREDENTIALS_PATH, SCOPES)
 client = gspread.authorize(creds)
 
-# Глобальный lock для всех операций с таблицей
-GS_LOCK = threading.Lock()
+# Глобальный lock для всех операций с таблицей (при COORD_DB_PATH — общий для всех воркеров)
+GS_LOCK = process_lock("gs")
 
 # Универсальные безопасные обёртки с ретраями
 def _with_retries(fn, *args, retries=3, backoff=0.7, **kwargs):
@@ -73,13 +271,26 @@ def _with_retries(fn, *args, retries=3, backoff=0.7, **kwargs):
     if last_err:
         raise last_err
 
-def gs_append_row_safe(ws, row: list):
+# Время последней записи бота в таблицу (epoch). По нему сверка отличает сдвиг modifiedTime
+# своими записями от ручных правок. При COORD_DB_PATH общее: записи соседнего воркера — тоже свои.
+_OWN_WRITES = shared_dict("sync")
+
+def own_write_at() -> float:
+    return _OWN_WRITES.get("own_write_at", 0.0)
+
+def _gs_write(fn, *args, **kwargs):
     with GS_LOCK:
-        return _with_retries(ws.append_row, row)
+        try:
+            return _with_retries(fn, *args, **kwargs)
+        finally:
+            # отмечаем и при ошибке: запрос мог дойти до таблицы
+            _OWN_WRITES["own_write_at"] = datetime.now().timestamp()
+
+def gs_append_row_safe(ws, row: list):
+    return _gs_write(ws.append_row, row)
 
 def gs_update_cell_safe(ws, r: int, c: int, value: str):
-    with GS_LOCK:
-        return _with_retries(ws.update_cell, r, c, value)
+    return _gs_write(ws.update_cell, r, c, value)
 
 def gs_get_all_records_safe(ws):
     with GS_LOCK:
@@ -93,6 +304,54 @@ def gs_row_values_safe(ws, row: int):
     with GS_LOCK:
         return _with_retries(ws.row_values, row)
 
+def gs_get_all_values_safe(ws):
+    with GS_LOCK:
+        return _with_retries(ws.get_all_values)
+
+def gs_get_range_safe(ws, rng: str):
+    with GS_LOCK:
+        return _with_retries(ws.get, rng)
+
+def gs_append_rows_safe(ws, rows: List[list]):
+    return _gs_write(ws.append_rows, rows)
+
+def gs_delete_rows_safe(ws, start: int, end: int):
+    return _gs_write(ws.delete_rows, start, end)
+
+def gs_batch_update_safe(ws, data: List[dict]):
+    # USER_ENTERED — как у update_cell, чтобы даты в листе выглядели одинаково
+    return _gs_write(ws.batch_update, data, value_input_option="USER_ENTERED")
+
+# Колонки, которые вводит человек (номер заказа от кассира). В USER_ENTERED «00123» стал бы числом 123,
+# а «=…» — формулой; ведущий апостроф Sheets понимает как «это текст» и в значении ячейки не хранит.
+TEXT_COLS = ("OrderID",)
+
+def cell_value(name: str, v) -> str:
+    s = "" if v is None else str(v)
+    return "'" + s if s and name in TEXT_COLS else s
+
+# Большие листы читаем кусками: get_all_values на 1M строк — это сотни МБ списков строк разом
+SHEET_READ_CHUNK = 10000
+
+def iter_sheet_rows(ws, ncols: int, first_row: int = 2):
+    """
+    Строки листа по одной, но читаются кусками по SHEET_READ_CHUNK строк (один get на кусок),
+    так что в памяти одновременно не больше одного куска. Пустые строки в середине листа
+    сохраняются (номер строки = first_row + порядковый номер), хвостовые — как в get_all_values, нет.
+    """
+    r = first_row
+    blank = 0
+    while True:
+        rows = gs_get_range_safe(ws, f"A{r}:{rowcol_to_a1(r + SHEET_READ_CHUNK - 1, max(ncols, 1))}")
+        if not rows:
+            return
+        # пустой хвост прошлого куска оказался серединой листа
+        for _ in range(blank):
+            yield []
+        yield from rows
+        blank = SHEET_READ_CHUNK - len(rows)
+        r += SHEET_READ_CHUNK
+
 def get_col_map(ws) -> dict:
     hdrs = gs_row_values_safe(ws, 1)
     return {h: i + 1 for i, h in enumerate(hdrs)}
@@ -101,10 +360,357 @@ def update_row_fields(ws, row_idx: int, fields: dict):
     colmap = get_col_map(ws)
     for k, v in fields.items():
         if k in colmap:
-            gs_update_cell_safe(ws, row_idx, colmap[k], "" if v is None else str(v))
+            gs_update_cell_safe(ws, row_idx, colmap[k], cell_value(k, v))
+
+# ---------- Компактное хранилище строк ----------
+TS_FMT = "%Y-%m-%d %H:%M:%S"   # формат, в котором бот пишет даты в таблицу
+_EPOCH = datetime(1970, 1, 1)
+_CODE_CHARS = string.digits + string.ascii_uppercase
+RAW = -1  # маркер «значение не влезло в формат колонки — смотри raw»
+
+def to_epoch(dt: datetime) -> int:
+    # без часовых поясов: наивное время таблицы как есть
+    return calendar.timegm(dt.timetuple())
+
+def from_epoch(ts: int) -> datetime:
+    return _EPOCH + timedelta(seconds=ts)
+
+def _enc_int(s: str) -> int:
+    return int(s) if s.isdigit() and 0 < int(s) < 2 ** 63 else RAW
+
+def _dec_int(v: int) -> str:
+    return str(v)
+
+def _enc_code(s: str) -> int:
+    # до 12 символов 0-9A-Z в base-37 (0 — «пусто»), влезает в int64
+    if len(s) > 12:
+        return RAW
+    v = 0
+    for ch in s:
+        k = _CODE_CHARS.find(ch)
+        if k < 0:
+            return RAW
+        v = v * 37 + k + 1
+    return v
+
+def _dec_code(v: int) -> str:
+    out = []
+    while v:
+        v, k = divmod(v, 37)
+        out.append(_CODE_CHARS[k - 1])
+    return "".join(reversed(out))
+
+def _enc_ts(s: str) -> int:
+    # разбор TS_FMT срезами — strptime на миллионе строк заметно медленнее при загрузке
+    if len(s) != 19 or s[4] != "-" or s[7] != "-" or s[10] != " " or s[13] != ":" or s[16] != ":":
+        return RAW
+    digits = s[0:4] + s[5:7] + s[8:10] + s[11:13] + s[14:16] + s[17:19]
+    if not (digits.isascii() and digits.isdigit()):
+        return RAW
+    y, mo, d = int(s[0:4]), int(s[5:7]), int(s[8:10])
+    h, mi, sec = int(s[11:13]), int(s[14:16]), int(s[17:19])
+    if not (1 <= mo <= 12 and 1 <= d <= calendar.monthrange(y, mo)[1] and h < 24 and mi < 60 and sec < 60):
+        return RAW
+    v = calendar.timegm((y, mo, d, h, mi, sec, 0, 0, 0))
+    return v if v > 0 else RAW
+
+def _dec_ts(v: int) -> str:
+    return from_epoch(v).strftime(TS_FMT)
+
+class PackedColumn:
+    """
+    int64 на строку (0 — пусто); значения, которые не кодируются, лежат как есть в raw.
+    indexed=True — для поиска держится индекс: keys (отсортированные значения) и rows (номера
+    записей, при равных ключах — по возрастанию), 16 байт на непустую строку, поиск через bisect.
+    Индекс строится при первом find, дальше его поддерживают append/set.
+    """
+    __slots__ = ("vals", "raw", "enc", "dec", "indexed", "keys", "rows")
+
+    def __init__(self, enc, dec, indexed: bool = False):
+        self.vals = array("q")
+        self.raw: Dict[int, str] = {}
+        self.enc, self.dec = enc, dec
+        self.indexed = indexed
+        self.keys: Optional[array] = None
+        self.rows: Optional[array] = None
+
+    def _build_index(self) -> None:
+        vals = self.vals
+        order = sorted((i for i in range(len(vals)) if vals[i] > 0), key=vals.__getitem__)
+        self.rows = array("q", order)
+        self.keys = array("q", (vals[i] for i in order))
+
+    def _index_add(self, v: int, i: int) -> None:
+        if self.keys is None or v <= 0:
+            return
+        lo, hi = bisect_left(self.keys, v), bisect_right(self.keys, v)
+        while lo < hi and self.rows[lo] < i:
+            lo += 1
+        self.keys.insert(lo, v)
+        self.rows.insert(lo, i)
+
+    def _index_remove(self, v: int, i: int) -> None:
+        if self.keys is None or v <= 0:
+            return
+        lo, hi = bisect_left(self.keys, v), bisect_right(self.keys, v)
+        for j in range(lo, hi):
+            if self.rows[j] == i:
+                del self.keys[j]
+                del self.rows[j]
+                return
+
+    def _encode(self, i: int, s: str) -> int:
+        v = self.enc(s) if s else 0
+        if v == RAW:
+            self.raw[i] = s
+        else:
+            self.raw.pop(i, None)
+        return v
+
+    def append(self, s: str) -> None:
+        i = len(self.vals)
+        v = self._encode(i, s)
+        self.vals.append(v)
+        if self.indexed:
+            self._index_add(v, i)
+
+    def set(self, i: int, s: str) -> None:
+        v = self._encode(i, s)
+        if self.indexed and v != self.vals[i]:
+            self._index_remove(self.vals[i], i)
+            self._index_add(v, i)
+        self.vals[i] = v
+
+    def get(self, i: int) -> str:
+        v = self.vals[i]
+        if v == RAW:
+            return self.raw[i]
+        return self.dec(v) if v else ""
+
+    def find(self, s: str) -> Optional[int]:
+        v = self.enc(s) if s else 0
+        if v > 0 and self.indexed:
+            if self.keys is None:
+                self._build_index()
+            j = bisect_left(self.keys, v)
+            return self.rows[j] if j < len(self.keys) and self.keys[j] == v else None
+        if v != RAW:
+            try:
+                return self.vals.index(v)  # линейный проход на C, без Python-объектов на строку
+            except ValueError:
+                return None
+        hits = [i for i, r in self.raw.items() if r == s]
+        return min(hits) if hits else None
+
+class EnumColumn:
+    """Интернированные значения с малой кардинальностью (Source, Discount, RedeemedBy)."""
+    __slots__ = ("ids", "pool", "lookup")
+
+    def __init__(self):
+        self.ids = array("I")
+        self.pool: List[str] = [""]
+        self.lookup: Dict[str, int] = {"": 0}
+
+    def _id(self, s: str) -> int:
+        k = self.lookup.get(s)
+        if k is None:
+            k = self.lookup[s] = len(self.pool)
+            self.pool.append(s)
+        return k
+
+    def append(self, s: str) -> None:
+        self.ids.append(self._id(s))
+
+    def set(self, i: int, s: str) -> None:
+        self.ids[i] = self._id(s)
+
+    def get(self, i: int) -> str:
+        return self.pool[self.ids[i]]
+
+    def find(self, s: str) -> Optional[int]:
+        k = self.lookup.get(s)
+        if k is None:
+            return None
+        try:
+            return self.ids.index(k)
+        except ValueError:
+            return None
+
+class TextColumn:
+    """Произвольный текст: UTF-8 подряд в одном bytearray + смещения. Перезапись дописывает в конец буфера."""
+    __slots__ = ("buf", "off", "size")
+
+    def __init__(self):
+        self.buf = bytearray()
+        self.off = array("Q")
+        self.size = array("I")
+
+    def _put(self, s: str) -> Tuple[int, int]:
+        b = s.encode("utf-8")
+        o = len(self.buf)
+        self.buf += b
+        return o, len(b)
+
+    def append(self, s: str) -> None:
+        o, n = self._put(s)
+        self.off.append(o)
+        self.size.append(n)
+
+    def set(self, i: int, s: str) -> None:
+        self.off[i], self.size[i] = self._put(s)
+
+    def get(self, i: int) -> str:
+        o = self.off[i]
+        return self.buf[o:o + self.size[i]].decode("utf-8")
+
+    def find(self, s: str) -> Optional[int]:
+        for i in range(len(self.off)):
+            if self.get(i) == s:
+                return i
+        return None
+
+class PromoStore:
+    """
+    Колоночное зеркало строк листа промокодов (вместо списка dict из get_all_records).
+    UserID/PromoCode/даты — int64 (дата — epoch для формата TS_FMT), Source/Discount/RedeemedBy —
+    интернированные значения, остальной текст — в общем UTF-8 буфере. Порядок строк как в листе:
+    запись i — это строка i + 2. ~100 байт на строку против ~1 КБ у dict.
+    Если есть колонки PromoCode/Source/DateIssued/UnsubscribedAt, стор сам ведёт счётчики
+    подписок/отписок по (источник, месяц) — их обновляет каждый append/set_fields.
+    """
+    STAT_COLS = ("PromoCode", "Source", "DateIssued", "UnsubscribedAt")
+    INT_COLS = ("UserID",)
+    CODE_COLS = ("PromoCode",)
+    TS_COLS = ("DateIssued", "DateRedeemed", "SubscribedSince", "UnsubscribedAt",
+               "SubscribeClickedAt", "AutoIssuedAt")
+    ENUM_COLS = ("Source", "Discount", "RedeemedBy", "ws")
+
+    def __init__(self, headers: List[str]):
+        self.headers: List[str] = []
+        self.cols: Dict[str, object] = {}
+        self.n = 0
+        self.lock = threading.RLock()
+        # (id источника в пуле Source, YYYYMM) -> число записей
+        self.subs: Dict[Tuple[int, int], int] = {}
+        self.unsubs: Dict[Tuple[int, int], int] = {}
+        for h in headers:
+            self.add_column(h)
+
+    @classmethod
+    def from_rows(cls, hdr: List[str], rows) -> "PromoStore":
+        """Стор из заголовка листа и итератора строк (строки не копятся — подходит потоковое чтение)."""
+        store = cls(hdr)
+        for row in rows:
+            # zip по заголовку листа, а не store.headers: пустые заголовки в store не попадают,
+            # и без них колонки правее съехали бы на одну
+            store.append({h: v for h, v in zip(hdr, row) if h})
+        return store
+
+    def _make_col(self, name: str):
+        if name in self.INT_COLS:
+            return PackedColumn(_enc_int, _dec_int, indexed=True)
+        if name in self.CODE_COLS:
+            return PackedColumn(_enc_code, _dec_code, indexed=True)
+        if name in self.TS_COLS:
+            return PackedColumn(_enc_ts, _dec_ts)
+        if name in self.ENUM_COLS:
+            return EnumColumn()
+        return TextColumn()
+
+    def add_column(self, name: str) -> None:
+        if not name or name in self.cols:
+            return
+        with self.lock:
+            col = self._make_col(name)
+            for _ in range(self.n):
+                col.append("")
+            self.cols[name] = col
+            self.headers.append(name)
+
+    def __len__(self) -> int:
+        return self.n
+
+    def append(self, rec: dict) -> int:
+        with self.lock:
+            for name, col in self.cols.items():
+                v = rec.get(name)
+                col.append("" if v is None else str(v))
+            self.n += 1
+            self._count(self.n - 1, 1)
+            return self.n - 1
+
+    def set_fields(self, i: int, fields: dict) -> None:
+        with self.lock:
+            touches_stats = any(k in self.STAT_COLS for k in fields)
+            if touches_stats:
+                self._count(i, -1)
+            for name, v in fields.items():
+                if name in self.cols:
+                    self.cols[name].set(i, "" if v is None else str(v))
+            if touches_stats:
+                self._count(i, 1)
+
+    def ts(self, i: int, name: str) -> int:
+        """epoch даты из колонки; нестандартный формат разбирается parse_iso, 0 — даты нет."""
+        col = self.cols[name]
+        v = col.vals[i]
+        if v == RAW:
+            dt = parse_iso(col.raw[i])
+            return to_epoch(dt) if dt else 0
+        return v
+
+    def _count(self, i: int, sign: int) -> None:
+        if not all(c in self.cols for c in self.STAT_COLS):
+            return
+        # считаем только записи с выданным кодом; дата подписки = дата выдачи (см. get_subscribe_date)
+        if not self.cols["PromoCode"].vals[i]:
+            return
+        src = self.cols["Source"].ids[i]
+        for counter, name in ((self.subs, "DateIssued"), (self.unsubs, "UnsubscribedAt")):
+            ts = self.ts(i, name)
+            if ts:
+                dt = from_epoch(ts)
+                key = (src, dt.year * 100 + dt.month)
+                counter[key] = counter.get(key, 0) + sign
+
+    def add_counts(self, month: Optional[int], subs: Dict[str, int], unsubs: Dict[str, int]) -> None:
+        """Добавляет счётчики за месяц YYYYMM (None — за всё время) в subs/unsubs по имени источника."""
+        with self.lock:
+            names = [(x or "default").strip() or "default" for x in self.cols["Source"].pool]
+            items = [(subs, list(self.subs.items())), (unsubs, list(self.unsubs.items()))]
+        for out, counter in items:
+            for (src, ym), cnt in counter:
+                if cnt and (month is None or ym == month):
+                    out[names[src]] = out.get(names[src], 0) + cnt
+
+    def get(self, i: int, name: str) -> str:
+        col = self.cols.get(name)
+        return col.get(i) if col else ""
+
+    def record(self, i: int) -> dict:
+        return {name: col.get(i) for name, col in self.cols.items()}
+
+    def rows(self):
+        for i in range(self.n):
+            yield [self.cols[h].get(i) for h in self.headers]
+
+    def find(self, name: str, value: str) -> Optional[int]:
+        col = self.cols.get(name)
+        if col is None:
+            return None
+        with self.lock:  # индекс колонки достраивается/сдвигается под тем же lock, что и append
+            i = col.find(value)
+        return i if i is not None and i < self.n else None
+
+    def find_user(self, user_id: int) -> Optional[int]:
+        return self.find("UserID", str(user_id))
+
+    def find_code(self, code: str) -> Optional[int]:
+        return self.find("PromoCode", code)
 
 # Основной лист
-sheet = client.open_by_key(SPREADSHEET_ID).sheet1
+spreadsheet = client.open_by_key(SPREADSHEET_ID)
+sheet = spreadsheet.sheet1
 HEADERS = [
     "UserID","Username","PromoCode","DateIssued","DateRedeemed","RedeemedBy",
     "OrderID","Source","SubscribedSince","Discount","UnsubscribedAt",
@@ -122,25 +728,29 @@ else:
 
 # Лист отзывов
 try:
-    feedback_ws = client.open_by_key(SPREADSHEET_ID).worksheet("Feedback")
+    feedback_ws = spreadsheet.worksheet("Feedback")
 except gspread.WorksheetNotFound:
-    feedback_ws = client.open_by_key(SPREADSHEET_ID).add_worksheet(title="Feedback", rows=2000, cols=6)
+    feedback_ws = spreadsheet.add_worksheet(title="Feedback", rows=2000, cols=6)
     gs_append_row_safe(feedback_ws, ["UserID","Username","Rating","Text","Photos","Date"])
 
 # ---------- Telegram ----------
-bot = telebot.TeleBot(BOT_TOKEN, parse_mode="HTML")
+# threaded=False: хендлеры выполняются в потоке, который вызвал process_new_updates, —
+# потоками и порядком управляет UpdateDispatcher (см. раздел FLASK/POLLING)
+bot = telebot.TeleBot(BOT_TOKEN, parse_mode="HTML", threaded=False)
+UPDATE_CTX = threading.local()  # update_id апдейта, который сейчас обрабатывает поток (для /profile)
 
-STATE: Dict[int, str] = {}
-USER_SOURCE: Dict[int, str] = {}   # фиксируем utm/источник из /start
-FEEDBACK_DRAFT: Dict[int, Dict] = {}
+STATE: Dict[int, str] = shared_dict("state")
+USER_SOURCE: Dict[int, str] = shared_dict("source")   # фиксируем utm/источник из /start
+FEEDBACK_DRAFT: Dict[int, Dict] = shared_dict("feedback_draft")
 
 # Для авто-проверок членства после нажатия «Подписаться»
-PENDING_SUB: Dict[int, Dict] = {}
+PENDING_SUB: Dict[int, Dict] = shared_dict("pending_sub")
 
 # ---------- Кнопки ----------
 BTN_ABOUT = "ℹ️ О бренде"
 BTN_FEEDBACK = "📝 Оставить отзыв"
 BTN_STAFF_VERIFY = "✅ Проверить/Погасить код"
+BTN_STAFF_BATCH = "📦 Погасить несколько кодов"
 BTN_ADMIN_ADD_STAFF = "➕ Добавить сотрудника"  # видна сотрудникам и админам
 BTN_STATS_MENU = "📊 Статистика"
 BTN_CANCEL = "❌ Отмена"
@@ -160,39 +770,76 @@ def add_staff_id(new_id: int) -> None:
     os.environ["STAFF_IDS"] = ",".join(str(x) for x in sorted(STAFF_IDS))
 
 # ---------- Клавиатуры ----------
-def make_main_keyboard(user_id: int):
+class FrozenMarkup(telebot.types.JsonSerializable):
+    """Клавиатура, сериализованная в JSON один раз: telebot отправляет готовую строку как есть."""
+    def __init__(self, markup):
+        self.json = markup.to_json()
+
+    def to_json(self):
+        return self.json
+
+def _build_main_keyboard(staff: bool):
     kb = telebot.types.ReplyKeyboardMarkup(resize_keyboard=True, row_width=2)
     kb.add(telebot.types.KeyboardButton(BTN_ABOUT), telebot.types.KeyboardButton(BTN_FEEDBACK))
-    if is_staff(user_id):
-        kb.add(telebot.types.KeyboardButton(BTN_STAFF_VERIFY))
+    if staff:
+        kb.add(telebot.types.KeyboardButton(BTN_STAFF_VERIFY), telebot.types.KeyboardButton(BTN_STAFF_BATCH))
         kb.add(telebot.types.KeyboardButton(BTN_STATS_MENU))
         kb.add(telebot.types.KeyboardButton(BTN_ADMIN_ADD_STAFF))
     return kb
 
-def rating_keyboard():
+def _build_rating_keyboard():
     kb = telebot.types.ReplyKeyboardMarkup(resize_keyboard=True, row_width=5)
     kb.add(*[telebot.types.KeyboardButton(x) for x in RATING_BTNS])
     kb.add(telebot.types.KeyboardButton(BTN_CANCEL))
     return kb
 
-def photos_keyboard():
+def _build_photos_keyboard():
     kb = telebot.types.ReplyKeyboardMarkup(resize_keyboard=True, row_width=2)
     kb.add(telebot.types.KeyboardButton(BTN_SEND_FEEDBACK), telebot.types.KeyboardButton(BTN_SKIP_PHOTOS))
     kb.add(telebot.types.KeyboardButton(BTN_CANCEL))
     return kb
 
-def inline_subscribe_keyboard():
+def _build_cancel_keyboard():
+    kb = telebot.types.ReplyKeyboardMarkup(resize_keyboard=True)
+    kb.add(telebot.types.KeyboardButton(BTN_CANCEL))
+    return kb
+
+def _build_inline_subscribe_keyboard():
     ikb = telebot.types.InlineKeyboardMarkup()
     ikb.add(telebot.types.InlineKeyboardButton("✅ Подписаться на канал", callback_data="want_subscribe"))
     ikb.add(telebot.types.InlineKeyboardButton("🎁Получить промокод", callback_data="check_and_issue"))
     return ikb
 
+# Собираются один раз на процесс (по роли), дальше переиспользуется готовый JSON
+MAIN_KEYBOARDS = {False: FrozenMarkup(_build_main_keyboard(False)), True: FrozenMarkup(_build_main_keyboard(True))}
+RATING_KEYBOARD = FrozenMarkup(_build_rating_keyboard())
+PHOTOS_KEYBOARD = FrozenMarkup(_build_photos_keyboard())
+CANCEL_KEYBOARD = FrozenMarkup(_build_cancel_keyboard())
+SUBSCRIBE_KEYBOARD = FrozenMarkup(_build_inline_subscribe_keyboard())
+
+def make_main_keyboard(user_id: int):
+    return MAIN_KEYBOARDS[is_staff(user_id)]
+
+def rating_keyboard():
+    return RATING_KEYBOARD
+
+def photos_keyboard():
+    return PHOTOS_KEYBOARD
+
+def cancel_keyboard():
+    return CANCEL_KEYBOARD
+
+def inline_subscribe_keyboard():
+    return SUBSCRIBE_KEYBOARD
+
 # ---------- Тексты ----------
 WELCOME = (
     "Добро пожаловать в <b>SBALO</b> 👠✨\n"
     "Здесь ты найдёшь вдохновение, узнаешь о новинках бренда и сможешь поделиться своим впечатлением.\n\n"
     "Выбирай кнопки снизу и будь ближе к миру SBALO."
 )
+PROMO_PROMPT = "Хочешь промокод? Нажми кнопку ниже 👇"
+WELCOME_WITH_PROMPT = WELCOME + "\n\n" + PROMO_PROMPT
 
 BRAND_ABOUT = (
     "<b>SBALO</b> в переводе с итальянского означает «высшая мера удовольствия» — именно это мы хотим дарить каждому.\n\n"
@@ -202,24 +849,61 @@ BRAND_ABOUT = (
     "SBALO — это твой стиль и твой комфорт в каждом шаге."
 )
 
+# Архивация удаляет строки из sheet1 и сдвигает номера — всё, что сначала ищет строку,
+# а потом пишет по её номеру, выполняется под этим lock. ARCHIVE_EPOCH растёт после каждого удаления.
+# При COORD_DB_PATH lock общий для воркеров, и при захвате зеркало догоняет их записи (coord_replay).
+SHEET_ROWS_LOCK = process_lock("rows", reentrant=True, on_acquire=lambda: coord_replay())
+ARCHIVE_EPOCH = 0
+
+def with_rows_lock(fn):
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        with SHEET_ROWS_LOCK:
+            return fn(*args, **kwargs)
+    return wrapper
+
 # ---------- Sheets утилиты ----------
-def append_row_dict(ws, header_list: List[str], data: dict):
-    headers_now = gs_row_values_safe(ws, 1)
-    if not headers_now:
-        gs_append_row_safe(ws, header_list)
-        headers_now = header_list[:]
-    row = [""] * len(headers_now)
+def sheet_append(data: dict) -> int:
+    """Дописывает строку в sheet1 и в зеркало. Возвращает номер строки в листе."""
+    row = [""] * len(headers)
     for k, v in data.items():
-        if k in headers_now:
-            row[headers_now.index(k)] = str(v)
-    gs_append_row_safe(ws, row)
+        if k in headers:
+            row[headers.index(k)] = "" if v is None else str(v)
+    gs_append_row_safe(sheet, row)  # append_row пишет RAW — апостроф для TEXT_COLS не нужен
+    rec = dict(zip(headers, row))
+    row_idx = PROMO_MIRROR.append(rec) + 2
+    coord_log("append", {"row": row_idx, "rec": rec})
+    return row_idx
+
+def sheet_update_fields(row_idx: int, fields: dict) -> None:
+    """Обновляет ячейки строки sheet1 и ту же строку зеркала."""
+    for k, v in fields.items():
+        if k in headers:
+            gs_update_cell_safe(sheet, row_idx, headers.index(k) + 1, cell_value(k, v))
+    PROMO_MIRROR.set_fields(row_idx - 2, fields)
+    coord_log("update", {"rows": {row_idx: fields}})
+
+def sheet_update_rows(updates: Dict[int, dict]) -> None:
+    """Как sheet_update_fields, но для многих строк сразу — одним batch_update в Sheets."""
+    data = []
+    for row_idx, fields in updates.items():
+        for k, v in fields.items():
+            if k in headers:
+                data.append({
+                    "range": rowcol_to_a1(row_idx, headers.index(k) + 1),
+                    "values": [[cell_value(k, v)]],
+                })
+    if data:
+        gs_batch_update_safe(sheet, data)
+    for row_idx, fields in updates.items():
+        PROMO_MIRROR.set_fields(row_idx - 2, fields)
+    coord_log("update", {"rows": updates})
 
 def get_row_by_user(user_id: int) -> Tuple[Optional[int], Optional[dict]]:
-    records = gs_get_all_records_safe(sheet)
-    for i, rec in enumerate(records, start=2):
-        if str(rec.get("UserID")) == str(user_id):
-            return i, rec
-    return None, None
+    i = PROMO_MIRROR.find_user(user_id)
+    if i is None:
+        return None, None
+    return i + 2, PROMO_MIRROR.record(i)
 
 def find_user_code(user_id: int) -> Tuple[Optional[int], Optional[str]]:
     i, rec = get_row_by_user(user_id)
@@ -228,22 +912,127 @@ def find_user_code(user_id: int) -> Tuple[Optional[int], Optional[str]]:
     return None, None
 
 def ensure_column(name: str):
+    if name in headers:
+        return
     hdrs = gs_row_values_safe(sheet, 1)
     if name not in hdrs:
         gs_update_cell_safe(sheet, 1, len(hdrs) + 1, name)
+        hdrs.append(name)
+    headers[:] = hdrs
+    for h in hdrs:
+        PROMO_MIRROR.add_column(h)
+    coord_log("headers", {"headers": hdrs})
 
 # ---------- Промо/подписка ----------
+# Визуально похожие символы — для подсказки кассиру при опечатке
+CONFUSABLE_GROUPS = ["0ODQ", "1IL7", "2Z", "5S", "6G", "8B", "UV"]
+
+def code_check_char(body: str) -> str:
+    # Luhn mod N по CODE_ALPHABET: ловит любую одиночную замену и почти все перестановки соседних символов
+    n = len(CODE_ALPHABET)
+    total, factor = 0, 2
+    for ch in reversed(body):
+        addend = factor * CODE_ALPHABET.index(ch)
+        total += addend // n + addend % n
+        factor = 3 - factor
+    return CODE_ALPHABET[(n - total % n) % n]
+
+def is_legacy_code(code: str) -> bool:
+    # старый формат: 4 символа A–Z/0–9 без контрольного символа
+    return len(code) == 4 and all(ch in (string.ascii_uppercase + string.digits) for ch in code)
+
+def is_valid_checked_code(code: str) -> bool:
+    return (len(code) == CODE_BODY_LEN + 1
+            and all(ch in CODE_ALPHABET for ch in code)
+            and code_check_char(code[:-1]) == code[-1])
+
+def normalize_code(text: str) -> str:
+    return "".join(ch for ch in (text or "").upper() if ch not in " -_")
+
+def _code_is_known(code: str) -> Optional[bool]:
+    # True — есть и не погашен, False — есть, но погашен, None — такого кода нет
+    i = PROMO_MIRROR.find_code(code)
+    if i is not None:
+        return not PROMO_MIRROR.get(i, "DateRedeemed")
+    rec = archive_lookup_code(code)
+    if rec:
+        return not rec.get("DateRedeemed")
+    return None
+
+SUGGEST_MAX_LOOKUPS = 16
+
+def suggest_code(code: str) -> Optional[str]:
+    """
+    Наиболее вероятный задуманный код для опечатки: одна замена символа или перестановка соседних,
+    с верным контрольным символом и реально выданный. Похожие по начертанию замены — в приоритете.
+    """
+    if len(code) != CODE_BODY_LEN + 1:
+        return None
+    similar = {a: g for g in CONFUSABLE_GROUPS for a in g}
+    candidates: Dict[str, int] = {}
+    for pos, ch in enumerate(code):
+        for repl in CODE_ALPHABET:
+            if repl != ch:
+                cand = code[:pos] + repl + code[pos + 1:]
+                rank = 0 if repl in similar.get(ch, "") else 2
+                candidates[cand] = min(rank, candidates.get(cand, rank))
+    for pos in range(len(code) - 1):
+        cand = code[:pos] + code[pos + 1] + code[pos] + code[pos + 2:]
+        candidates[cand] = min(1, candidates.get(cand, 1))
+
+    # проверяем по индексу не больше SUGGEST_MAX_LOOKUPS кандидатов, самые вероятные — первыми;
+    # первый найденный непогашенный код уже не перебить (дальше ранг только хуже),
+    # разве что погашенный с рангом лучше — ранг важнее состояния
+    fallback: Optional[Tuple[int, str]] = None
+    lookups = 0
+    for rank, cand in sorted((rank, cand) for cand, rank in candidates.items()):
+        if cand == code or not is_valid_checked_code(cand):
+            continue
+        if lookups >= SUGGEST_MAX_LOOKUPS:
+            break
+        lookups += 1
+        known = _code_is_known(cand)
+        if known:
+            return fallback[1] if fallback and fallback[0] < rank else cand
+        if known is False and fallback is None:
+            fallback = (rank, cand)
+    return fallback[1] if fallback else None
+
+def validate_code(text: str) -> Tuple[Optional[str], str]:
+    """
+    Локальная проверка кода без обращения к таблице.
+    Возвращает (код, "") если его можно отправлять в redeem_code, иначе (None, текст ответа кассиру).
+    """
+    code = normalize_code(text)
+    if is_legacy_code(code) or is_valid_checked_code(code):
+        return code, ""
+    if len(code) == CODE_BODY_LEN + 1:
+        hint = suggest_code(code)
+        msg = f"❌ Код <b>{code}</b> с опечаткой (не сходится контрольный символ)."
+        if hint:
+            msg += f"\nВозможно, имелся в виду <b>{hint}</b>?"
+        return None, msg
+    return None, f"Неверный формат. Введите код из {CODE_BODY_LEN + 1} символов (или старый из 4 символов A–Z/0–9)."
+
 def generate_short_code() -> str:
-    # 4 символа A–Z/0–9, минимум одна буква
-    alphabet = string.ascii_uppercase + string.digits
+    # тело из CODE_ALPHABET + контрольный символ; не совпадает с уже выданными (sheet1 и архив)
     while True:
-        code = "".join(random.choices(alphabet, k=4))
-        if any(ch.isalpha() for ch in code):
+        body = "".join(random.choices(CODE_ALPHABET, k=CODE_BODY_LEN))
+        code = body + code_check_char(body)
+        if PROMO_MIRROR.find_code(code) is None and ARCHIVE.find_code(code) is None:
             return code
 
+@with_rows_lock
 def ensure_subscribed_since(user_id: int) -> datetime:
     i, rec = get_row_by_user(user_id)
     now = datetime.now().isoformat(sep=" ", timespec="seconds")
+    if not i:
+        # строка уехала в архив — вторую строку в sheet1 не заводим, берём дату оттуда
+        archived = archive_lookup_user(user_id)
+        if archived:
+            return (parse_iso(archived.get("SubscribedSince") or "")
+                    or parse_iso(archived.get("DateIssued") or "")
+                    or datetime.fromisoformat(now))
     ensure_column("SubscribedSince")
     if i and rec.get("SubscribedSince"):
         try:
@@ -251,10 +1040,9 @@ def ensure_subscribed_since(user_id: int) -> datetime:
         except Exception:
             pass
     if i:
-        col = gs_row_values_safe(sheet, 1).index("SubscribedSince") + 1
-        gs_update_cell_safe(sheet, i, col, now)
+        sheet_update_fields(i, {"SubscribedSince": now})
     else:
-        append_row_dict(sheet, HEADERS, {
+        sheet_append({
             "UserID": str(user_id),
             "Source": "subscribe_check",
             "SubscribedSince": now
@@ -264,13 +1052,19 @@ def ensure_subscribed_since(user_id: int) -> datetime:
 def can_issue(user_id: int) -> bool:
     if SUBSCRIPTION_MIN_DAYS <= 0:
         return True
+    # код уже выдан (в sheet1 или в архиве) — issue_code просто вернёт его
+    _, rec = get_row_by_user(user_id)
+    archived = archive_lookup_user(user_id)
+    if (rec and rec.get("PromoCode")) or (archived and archived.get("PromoCode")):
+        return True
     since = ensure_subscribed_since(user_id)
     return (datetime.now() - since).days >= SUBSCRIPTION_MIN_DAYS
 
+@with_rows_lock
 def issue_code(user_id: int, username: str, source: str = "subscribe") -> Tuple[str, bool]:
     """
     UPsert: гарантируем 1 код и 1 строку на пользователя.
-    - Если код уже есть — возвращаем его (created=False).
+    - Если код уже есть (в sheet1 или в архиве) — возвращаем его (created=False).
     - Если строки нет — создаём новую.
     - Если строка есть — обновляем её полями PromoCode/DateIssued/Discount.
       Source заполняем только если пуст (чтобы не перетирать UTM из /start).
@@ -279,6 +1073,9 @@ def issue_code(user_id: int, username: str, source: str = "subscribe") -> Tuple[
     row_idx, rec = get_row_by_user(user_id)
     if row_idx and rec and rec.get("PromoCode"):
         return rec["PromoCode"], False
+    archived = archive_lookup_user(user_id)
+    if archived and archived["PromoCode"]:
+        return archived["PromoCode"], False
 
     now = datetime.now().isoformat(sep=" ", timespec="seconds")
     code = generate_short_code()
@@ -294,9 +1091,9 @@ def issue_code(user_id: int, username: str, source: str = "subscribe") -> Tuple[
             fields["Source"] = source
         if source == "auto_issue" and not rec.get("AutoIssuedAt"):
             fields["AutoIssuedAt"] = now
-        update_row_fields(sheet, row_idx, fields)
+        sheet_update_fields(row_idx, fields)
     else:
-        append_row_dict(sheet, HEADERS, {
+        sheet_append({
             "UserID": str(user_id),
             "Username": username or "",
             "PromoCode": code,
@@ -316,20 +1113,33 @@ def issue_code(user_id: int, username: str, source: str = "subscribe") -> Tuple[
 
     return rec2["PromoCode"], True
 
-def redeem_code(code: str, staff_username: str) -> Tuple[bool, str]:
-    try:
-        cell = gs_find_safe(sheet, code)
-    except Exception:
-        return False, "Промокод не найден ❌"
-
-    if not cell:
-        return False, "Промокод не найден ❌"
-
-    row_idx = cell.row
-    headers_now = gs_row_values_safe(sheet, 1)
-    recs = gs_get_all_records_safe(sheet)
-    rec = recs[row_idx - 2] if row_idx >= 2 and (row_idx - 2) < len(recs) else {}
+@with_rows_lock
+def redeem_code(code: str, staff_username: str, order_id: str = "") -> Tuple[bool, str]:
+    i = PROMO_MIRROR.find_code(code)
+    if i is not None:
+        return _redeem_row(PROMO_MIRROR.record(i), code, staff_username, order_id,
+                           lambda fields: sheet_update_fields(i + 2, fields))
 
+    # Нет в sheet1 — возможно, строка уже в архиве
+    archived = archive_lookup_code(code)
+    if archived:
+        try:
+            ws = spreadsheet.worksheet(archived["ws"])
+            cell = gs_find_safe(ws, code)
+        except Exception:
+            cell = None
+        if cell:
+            recs = gs_get_all_records_safe(ws)
+            rec = recs[cell.row - 2] if 0 <= cell.row - 2 < len(recs) else {}
+            ok, reply = _redeem_row(rec, code, staff_username, order_id,
+                                    lambda fields: update_row_fields(ws, cell.row, fields))
+            if ok:
+                archive_mark_redeemed(code, datetime.now().isoformat(sep=" ", timespec="seconds"))
+            return ok, reply
+
+    return False, "Промокод не найден ❌"
+
+def _redeem_row(rec: dict, code: str, staff_username: str, order_id: str, write_fields) -> Tuple[bool, str]:
     if rec.get("DateRedeemed"):
         return False, (
             "❌ Код уже погашен ранее.\n"
@@ -339,10 +1149,11 @@ def redeem_code(code: str, staff_username: str) -> Tuple[bool, str]:
             f"Погасил: {rec.get('RedeemedBy', '')}\n"
         )
 
-    idx = {h: headers_now.index(h) for h in headers_now if h in headers_now}
     now = datetime.now().isoformat(sep=" ", timespec="seconds")
-    gs_update_cell_safe(sheet, row_idx, idx["DateRedeemed"] + 1, now)
-    gs_update_cell_safe(sheet, row_idx, idx["RedeemedBy"] + 1, staff_username or "Staff")
+    fields = {"DateRedeemed": now, "RedeemedBy": staff_username or "Staff"}
+    if order_id:
+        fields["OrderID"] = order_id
+    write_fields(fields)
 
     discount = rec.get("Discount", DISCOUNT_LABEL)
     issued = rec.get("DateIssued", "")
@@ -358,29 +1169,185 @@ def redeem_code(code: str, staff_username: str) -> Tuple[bool, str]:
     )
     return True, reply
 
-def is_subscribed(user_id: int) -> bool:
+# ---------- Пакетное погашение ----------
+BATCH_MAX_CODES = 50
+
+def parse_batch(text: str) -> List[Tuple[str, str]]:
+    """
+    Разбирает список кодов: через пробел, запятую, «;» или с новой строки.
+    Номер заказа привязывается через двоеточие или «=»: ABC23X:10045.
+    Возвращает [(код как ввели, OrderID)].
+    """
+    items = []
+    for token in re.split(r"[\s,;]+", text or ""):
+        if not token:
+            continue
+        parts = re.split(r"[:=]", token, maxsplit=1)
+        items.append((parts[0], parts[1].strip() if len(parts) > 1 else ""))
+    return items
+
+@with_rows_lock
+def redeem_codes_batch(items: List[Tuple[str, str]], staff_username: str) -> List[Tuple[bool, str]]:
+    """
+    Проверяет и гасит пачку кодов за один проход: проверка формата и поиск — локально по зеркалу,
+    запись всех погашений из sheet1 — одним batch_update. Коды из архива гасятся по одному (редкость).
+    Возвращает [(погашен ли, строка отчёта)] в порядке ввода.
+    """
+    staff = staff_username or "Staff"
+    now = datetime.now().isoformat(sep=" ", timespec="seconds")
+    results: List[Optional[Tuple[bool, str]]] = []
+    updates: Dict[int, dict] = {}
+    pending: List[Tuple[int, str, dict, str]] = []  # (позиция в results, код, запись, заказ)
+    seen: Set[str] = set()
+
+    for raw, order in items:
+        code, _ = validate_code(raw)
+        order_txt = f", заказ {html.escape(order)}" if order else ""
+        if not code:
+            typed = normalize_code(raw)
+            if len(typed) != CODE_BODY_LEN + 1:
+                results.append((False, f"⚠️ {html.escape(typed)} — неверный формат"))
+                continue
+            hint = suggest_code(typed)
+            results.append((False, f"⚠️ {html.escape(typed)} — опечатка" + (f", возможно <b>{hint}</b>" if hint else "")))
+            continue
+        if code in seen:
+            results.append((False, f"🔁 {code} — повтор в списке"))
+            continue
+        seen.add(code)
+
+        i = PROMO_MIRROR.find_code(code)
+        if i is None:
+            archived = archive_lookup_code(code)
+            if not archived:
+                results.append((False, f"❓ {code} — не найден"))
+            elif archived.get("DateRedeemed"):
+                results.append((False, f"❌ {code} — уже погашен {archived['DateRedeemed']} (архив)"))
+            else:
+                ok, _ = redeem_code(code, staff_username, order)
+                results.append((ok, f"✅ {code} — погашен (архив){order_txt}" if ok else f"❓ {code} — не найден"))
+            continue
+        rec = PROMO_MIRROR.record(i)
+        if rec.get("DateRedeemed"):
+            results.append((False, f"❌ {code} — уже погашен {rec['DateRedeemed']} ({rec.get('RedeemedBy', '')})"))
+            continue
+        fields = {"DateRedeemed": now, "RedeemedBy": staff}
+        if order:
+            fields["OrderID"] = order
+        updates[i + 2] = fields
+        pending.append((len(results), code, rec, order_txt))
+        results.append(None)
+
+    try:
+        sheet_update_rows(updates)
+        for pos, code, rec, order_txt in pending:
+            results[pos] = (True, f"✅ {code} — погашен, скидка {rec.get('Discount') or DISCOUNT_LABEL}{order_txt}")
+    except Exception as e:
+        print("batch redeem write error:", e)
+        for pos, code, _, _ in pending:
+            results[pos] = (False, f"⛔ {code} — не записан, ошибка таблицы, повторите")
+    return results
+
+def format_batch_report(results: List[Tuple[bool, str]]) -> str:
+    done = sum(1 for ok, _ in results if ok)
+    lines = [f"📦 Пакетное погашение: погашено {done} из {len(results)}", ""]
+    lines += [line for _, line in results]
+    return "\n".join(lines)
+
+# ---------- Кэш членства в канале ----------
+MEMBER_OK_STATUSES = ("member", "administrator", "creator")
+
+# user_id -> (status, expires_at по monotonic); порядок = LRU
+MEMBER_CACHE: "OrderedDict[int, Tuple[str, float]]" = OrderedDict()
+# user_id -> Event для запроса get_chat_member, который уже выполняется
+MEMBER_INFLIGHT: Dict[int, threading.Event] = {}
+MEMBER_LOCK = threading.Lock()
+
+def member_cache_put(user_id: int, status: str) -> None:
+    ttl = MEMBER_CACHE_TTL_POS if status in MEMBER_OK_STATUSES else MEMBER_CACHE_TTL_NEG
+    with MEMBER_LOCK:
+        MEMBER_CACHE[user_id] = (status, monotonic() + ttl)
+        MEMBER_CACHE.move_to_end(user_id)
+        while len(MEMBER_CACHE) > MEMBER_CACHE_MAX:
+            MEMBER_CACHE.popitem(last=False)
+
+def member_cache_invalidate(user_id: int) -> None:
+    with MEMBER_LOCK:
+        MEMBER_CACHE.pop(user_id, None)
+
+def _member_cache_get(user_id: int) -> Optional[str]:
+    # вызывать под MEMBER_LOCK
+    hit = MEMBER_CACHE.get(user_id)
+    if not hit:
+        return None
+    status, expires_at = hit
+    if expires_at < monotonic():
+        MEMBER_CACHE.pop(user_id, None)
+        return None
+    MEMBER_CACHE.move_to_end(user_id)
+    return status
+
+def get_member_status(user_id: int) -> Optional[str]:
+    """
+    Статус пользователя в канале (member/left/kicked/...) через кэш.
+    Параллельные запросы по одному user_id склеиваются: в Telegram уходит один get_chat_member,
+    остальные ждут его результат. Ошибки API не кэшируются — возвращается None.
+    """
+    with MEMBER_LOCK:
+        status = _member_cache_get(user_id)
+        if status is not None:
+            return status
+        ev = MEMBER_INFLIGHT.get(user_id)
+        leader = ev is None
+        if leader:
+            ev = MEMBER_INFLIGHT[user_id] = threading.Event()
+
+    if not leader:
+        ev.wait(timeout=30)
+        with MEMBER_LOCK:
+            return _member_cache_get(user_id)
+
     try:
         m = bot.get_chat_member(chat_id=CHANNEL_USERNAME, user_id=user_id)
-        return m.status in ("member", "administrator", "creator")
+        member_cache_put(user_id, m.status)
+        return m.status
     except Exception:
-        return False
+        return None
+    finally:
+        with MEMBER_LOCK:
+            MEMBER_INFLIGHT.pop(user_id, None)
+        ev.set()
+
+def is_subscribed(user_id: int) -> bool:
+    return get_member_status(user_id) in MEMBER_OK_STATUSES
+
+@bot.chat_member_handler()
+def on_chat_member_update(upd):
+    # Telegram присылает chat_member только если бот — админ канала; кладём свежий статус в кэш
+    chat_username = (getattr(upd.chat, "username", "") or "").lower()
+    if chat_username != CHANNEL_USERNAME.lstrip("@").lower():
+        return
+    member = upd.new_chat_member
+    if member and member.user:
+        member_cache_put(member.user.id, member.status)
 
 # ---------- Логика «Подписаться» с источником и авто-выдачей кода ----------
+@with_rows_lock
 def mark_subscribe_click(user_id: int, username: str):
     ensure_column("SubscribeClickedAt")
     now = datetime.now().isoformat(sep=" ", timespec="seconds")
     src = USER_SOURCE.get(user_id, "direct")
 
     i, rec = get_row_by_user(user_id)
+    if not i and archive_lookup_user(user_id):
+        return  # строка пользователя в архиве — новую в sheet1 не заводим
     if i:
-        hdrs = gs_row_values_safe(sheet, 1)
-        col = hdrs.index("SubscribeClickedAt") + 1
-        gs_update_cell_safe(sheet, i, col, now)
+        fields = {"SubscribeClickedAt": now}
         if not rec.get("Source"):  # не перетираем уже заданный источник
-            col_src = hdrs.index("Source") + 1
-            gs_update_cell_safe(sheet, i, col_src, src)
+            fields["Source"] = src
+        sheet_update_fields(i, fields)
     else:
-        append_row_dict(sheet, HEADERS, {
+        sheet_append({
             "UserID": str(user_id),
             "Username": username or "",
             "Source": src,
@@ -396,11 +1363,11 @@ def schedule_membership_checks(user_id: int, chat_id: int):
       - пользователю ничего не пишем
     """
     delays = [20, 120, 600]
-    PENDING_SUB[user_id] = {"chat_id": chat_id, "t0": datetime.now()}
+    PENDING_SUB[user_id] = {"chat_id": chat_id, "t0": datetime.now().isoformat(sep=" ", timespec="seconds")}
 
     def _check():
         _, rec = get_row_by_user(user_id)
-        if rec and rec.get("PromoCode"):
+        if (rec and rec.get("PromoCode")) or archive_lookup_user(user_id):
             PENDING_SUB.pop(user_id, None)
             return
 
@@ -417,30 +1384,120 @@ def schedule_membership_checks(user_id: int, chat_id: int):
     for d in delays:
         Timer(d, _check).start()
 
+# ---------- Колбэки в две фазы ----------
+BG_POOL = ThreadPoolExecutor(max_workers=BG_WORKERS, thread_name_prefix="cb")
+CB_INFLIGHT: Set[Tuple[int, str]] = set()   # (user_id, callback_data), которые сейчас считаются
+CB_LOCK = threading.Lock()
+
+def run_callback_in_background(cb, placeholder: str, work) -> None:
+    """
+    Фаза 1: сразу answer_callback_query и сообщение-заглушка. Фаза 2: work() в BG_POOL,
+    его результат (text, inline_markup|None) заменяет текст заглушки.
+    Повторные нажатия той же кнопки тем же пользователем, пока идёт работа, склеиваются в один запуск.
+    """
+    key = (cb.from_user.id, cb.data)
+    with CB_LOCK:
+        busy = key in CB_INFLIGHT
+        CB_INFLIGHT.add(key)
+    try:
+        bot.answer_callback_query(cb.id, "Уже проверяю, секунду…" if busy else None)
+    except Exception:
+        pass
+    if busy:
+        return
+
+    try:
+        msg = bot.send_message(cb.message.chat.id, placeholder)
+    except Exception as e:
+        print("callback placeholder error:", e)
+        with CB_LOCK:
+            CB_INFLIGHT.discard(key)
+        return
+
+    update_id = getattr(UPDATE_CTX, "update_id", None)
+
+    def _run():
+        UPDATE_CTX.update_id = update_id
+        try:
+            text, markup = work()
+        except Exception as e:
+            print("callback work error:", e)
+            text, markup = "Сервис временно недоступен. Попробуйте ещё раз чуть позже 🙏", None
+        try:
+            bot.edit_message_text(text, chat_id=msg.chat.id, message_id=msg.message_id, reply_markup=markup)
+        except Exception as e:
+            print("callback edit error:", e)
+        finally:
+            with CB_LOCK:
+                CB_INFLIGHT.discard(key)
+
+    BG_POOL.submit(_run)
+
+def run_admin_job(message, title: str, work) -> None:
+    """
+    Долгая админ-команда (проход по всем строкам, архивация, перечитка листа) — в BG_POOL,
+    чтобы не держать воркер диспетчера и очередь апдейтов других пользователей.
+    work() возвращает текст ответа; он приходит отдельным сообщением, когда всё готово.
+    """
+    bot.reply_to(message, f"{title}: запущено, пришлю результат.")
+    update_id = getattr(UPDATE_CTX, "update_id", None)
+
+    def _run():
+        UPDATE_CTX.update_id = update_id
+        try:
+            text = work()
+        except Exception as e:
+            print(f"{title} error:", e)
+            text = f"{title}: ошибка — {html.escape(str(e))}"
+        try:
+            bot.reply_to(message, text)
+        except Exception as e:
+            print("admin job reply error:", e)
+
+    BG_POOL.submit(_run)
+
 # ---------- Старт/кнопки ----------
+# user_id -> роль (сотрудник?), для которой /start уже отправил главную клавиатуру; LRU
+MAIN_KB_SHOWN: "OrderedDict[int, bool]" = OrderedDict()
+MAIN_KB_SHOWN_MAX = 50000
+
 @bot.message_handler(commands=["start", "help"])
 def start(message):
     parts = message.text.split(maxsplit=1)
     if len(parts) > 1 and parts[1].strip():
         USER_SOURCE[message.from_user.id] = parts[1].strip()[:32].lower()
-    bot.send_message(message.chat.id, WELCOME, reply_markup=make_main_keyboard(message.from_user.id))
-    bot.send_message(message.chat.id, "Хочешь промокод? Нажми кнопку ниже 👇", reply_markup=inline_subscribe_keyboard())
+    uid = message.from_user.id
+    staff = is_staff(uid)
+    # Нижняя клавиатура у клиента сохраняется: если этот процесс её уже показал (той же роли)
+    # и пользователь не в середине сценария, хватит одного сообщения с inline-кнопками.
+    if MAIN_KB_SHOWN.get(uid) == staff and uid not in STATE:
+        bot.send_message(message.chat.id, WELCOME_WITH_PROMPT, reply_markup=inline_subscribe_keyboard())
+        return
+    bot.send_message(message.chat.id, WELCOME, reply_markup=make_main_keyboard(uid))
+    bot.send_message(message.chat.id, PROMO_PROMPT, reply_markup=inline_subscribe_keyboard())
+    MAIN_KB_SHOWN[uid] = staff
+    MAIN_KB_SHOWN.move_to_end(uid)
+    while len(MAIN_KB_SHOWN) > MAIN_KB_SHOWN_MAX:
+        MAIN_KB_SHOWN.popitem(last=False)
 
 @bot.callback_query_handler(func=lambda c: c.data == "check_and_issue")
 def cb_check_and_issue(cb):
-    do_check_subscription(cb.message.chat.id, cb.from_user)
-    try:
-        bot.answer_callback_query(cb.id)
-    except Exception:
-        pass
+    user = cb.from_user
+    run_callback_in_background(cb, "⏳ Проверяю подписку…", lambda: do_check_subscription(user))
 
 @bot.callback_query_handler(func=lambda c: c.data == "want_subscribe")
 def cb_want_subscribe(cb):
     u = cb.from_user
     chat_id = cb.message.chat.id
+    try:
+        bot.answer_callback_query(cb.id)
+    except Exception:
+        pass
 
     if u.id not in USER_SOURCE:
         USER_SOURCE[u.id] = "direct"
+    # пользователь идёт подписываться — старый «не подписан» в кэше больше не актуален
+    member_cache_invalidate(u.id)
 
     try:
         mark_subscribe_click(u.id, u.username or "")
@@ -460,37 +1517,23 @@ def cb_want_subscribe(cb):
     except Exception as e:
         print("schedule_membership_checks error:", e)
 
-    try:
-        bot.answer_callback_query(cb.id)
-    except Exception:
-        pass
-
-def do_check_subscription(chat_id: int, user):
+def do_check_subscription(user) -> Tuple[str, Optional[object]]:
+    """Проверка подписки и выдача кода. Возвращает (текст ответа, inline-клавиатура или None)."""
     if not is_subscribed(user.id):
-        bot.send_message(
-            chat_id,
-            f"Подпишись на {CHANNEL_USERNAME}, затем повтори проверку.",
-            reply_markup=inline_subscribe_keyboard()
-        )
-        return
+        return f"Подпишись на {CHANNEL_USERNAME}, затем повтори проверку.", inline_subscribe_keyboard()
     if not can_issue(user.id):
-        bot.send_message(chat_id, "Спасибо за подписку! Промокод станет доступен позже.")
-        return
+        return "Спасибо за подписку! Промокод станет доступен позже.", None
 
     src = USER_SOURCE.get(user.id, "subscribe")
     try:
         code, _ = issue_code(user.id, user.username, source=src)
-        bot.send_message(
-            chat_id,
-            f"Спасибо за подписку на {CHANNEL_USERNAME}! 🎉\nТвой промокод: <b>{code}</b>",
-            parse_mode="HTML"
-        )
+        return f"Спасибо за подписку на {CHANNEL_USERNAME}! 🎉\nТвой промокод: <b>{code}</b>", None
     except Exception as e:
         alert = f"⚠️ Не удалось записать промокод в таблицу для user {user.id} (@{user.username}). Ошибка: {e}"
         for admin_id in ADMIN_IDS:
             try: bot.send_message(admin_id, alert)
             except Exception: pass
-        bot.send_message(chat_id, "Сервис временно недоступен. Попробуйте ещё раз чуть позже 🙏")
+        return "Сервис временно недоступен. Попробуйте ещё раз чуть позже 🙏", None
 
 @bot.message_handler(func=lambda m: m.text == BTN_ABOUT)
 def handle_about(message):
@@ -545,52 +1588,47 @@ def ensure_unsubscribed_col():
 def refresh_unsubs(max_checks: Optional[int] = None) -> Tuple[int, int]:
     """Проставляет UnsubscribedAt тем, кто вышел из канала. Команда /subs_refresh (только админ)."""
     ensure_unsubscribed_col()
-    hdrs = gs_row_values_safe(sheet, 1)
-    idx = {h: hdrs.index(h) for h in hdrs}
     updated = 0
     checked = 0
-    records = gs_get_all_records_safe(sheet)
-    for i, rec in enumerate(records, start=2):
+    epoch = ARCHIVE_EPOCH
+    store = PROMO_MIRROR
+    for i in range(len(store)):
         if max_checks is not None and checked >= max_checks:
             break
+        rec = store.record(i)
         uid = rec.get("UserID")
-        if not uid:
+        if not uid or not uid.isdigit():
             continue
-        uid = int(str(uid))
+        uid = int(uid)
         if rec.get("UnsubscribedAt"):
             continue
         if not get_subscribe_date(rec):
             continue
         checked += 1
         try:
-            m = bot.get_chat_member(chat_id=CHANNEL_USERNAME, user_id=uid)
-            if m.status in ("left", "kicked"):
+            if get_member_status(uid) in ("left", "kicked"):
                 now = datetime.now().isoformat(sep=" ", timespec="seconds")
-                gs_update_cell_safe(sheet, i, idx["UnsubscribedAt"] + 1, now)
-                updated += 1
+                with SHEET_ROWS_LOCK:
+                    # пока шла проверка, архивация могла сдвинуть строки — ищем заново
+                    row_i = i + 2 if ARCHIVE_EPOCH == epoch else get_row_by_user(uid)[0]
+                    if row_i:
+                        sheet_update_fields(row_i, {"UnsubscribedAt": now})
+                        updated += 1
         except Exception:
             pass
     return checked, updated
 
 def aggregate_by_source(period: Optional[Tuple[datetime, datetime]] = None) -> Tuple[Dict[str, int], Dict[str, int]]:
+    """period — целый месяц из month_bounds или None (всё время): оба берутся из готовых счётчиков сторов."""
     subs: Dict[str, int] = {}
     unsubs: Dict[str, int] = {}
-    records = gs_get_all_records_safe(sheet)
-    for rec in records:
-        # считаем только записи с выданным кодом
-        if not rec.get("PromoCode"):
-            continue
-
-        src = (rec.get("Source") or "default").strip() or "default"
-
-        sub_dt = get_subscribe_date(rec)  # уже фильтрует по PromoCode
-        if sub_dt and (period is None or (period[0] <= sub_dt <= period[1])):
-            subs[src] = subs.get(src, 0) + 1
-
-        unsub_dt = parse_iso(rec.get("UnsubscribedAt") or "")
-        if unsub_dt and (period is None or (period[0] <= unsub_dt <= period[1])):
-            unsubs[src] = unsubs.get(src, 0) + 1
-
+    month = None
+    if period:
+        if period != month_bounds(period[0].year, period[0].month):
+            raise ValueError("aggregate_by_source: поддерживаются только целые месяцы")
+        month = period[0].year * 100 + period[0].month
+    for store in (PROMO_MIRROR, ARCHIVE):
+        store.add_counts(month, subs, unsubs)
     return subs, unsubs
 
 def format_stats_by_source(title: str, subs: Dict[str, int], unsubs: Dict[str, int]) -> str:
@@ -609,13 +1647,495 @@ def format_stats_by_source(title: str, subs: Dict[str, int], unsubs: Dict[str, i
     lines.append(f"Итого: подписки {total_sub}, отписки {total_unsub}, прирост {total_sub - total_unsub:+d}")
     return "\n".join(lines)
 
+# ---------- Архив (холодные строки) ----------
+ARCHIVE_PREFIX = "Archive "
+# Компактный локальный индекс архива: по строке на UserID, только поля для выдачи/погашения/статистики
+# (при смене набора полей старый файл индекса не подходит и индекс один раз пересобирается из листов)
+ARCHIVE_FIELDS = ["UserID", "PromoCode", "ws", "Source", "DateIssued", "DateRedeemed", "UnsubscribedAt",
+                  "SubscribedSince"]
+ARCHIVE = PromoStore(ARCHIVE_FIELDS)
+
+def archive_lookup_user(user_id: int) -> Optional[dict]:
+    i = ARCHIVE.find_user(user_id)
+    return ARCHIVE.record(i) if i is not None else None
+
+def archive_lookup_code(code: str) -> Optional[dict]:
+    i = ARCHIVE.find_code(code)
+    return ARCHIVE.record(i) if i is not None else None
+
+def _archive_put(user_id: int, rec: dict, title: str) -> None:
+    fields = {k: rec.get(k, "") for k in ARCHIVE_FIELDS}
+    fields["UserID"] = str(user_id)
+    fields["ws"] = title
+    with ARCHIVE.lock:
+        i = ARCHIVE.find_user(user_id)
+        if i is None:
+            ARCHIVE.append(fields)
+        else:
+            ARCHIVE.set_fields(i, fields)
+
+def archive_mark_redeemed(code: str, when: str) -> None:
+    i = ARCHIVE.find_code(code)
+    if i is None:
+        return
+    ARCHIVE.set_fields(i, {"DateRedeemed": when})
+    save_archive_index()
+    coord_log("archive_redeemed", {"code": code, "when": when})
+
+def save_archive_index() -> None:
+    with ARCHIVE.lock:
+        data = {"fields": ARCHIVE_FIELDS, "rows": list(ARCHIVE.rows())}
+    tmp = f"{ARCHIVE_INDEX_PATH}.{os.getpid()}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False, separators=(",", ":"))
+    os.replace(tmp, ARCHIVE_INDEX_PATH)
+
+def _rows_as_records(values: List[list]) -> List[dict]:
+    if not values:
+        return []
+    hdrs = values[0]
+    return [dict(zip(hdrs, row)) for row in values[1:]]
+
+def load_archive_index() -> int:
+    """Читает индекс с диска; если файла нет (новый инстанс) — один раз собирает его из листов архива."""
+    try:
+        with open(ARCHIVE_INDEX_PATH, encoding="utf-8") as f:
+            data = json.load(f)
+        if data.get("fields") == ARCHIVE_FIELDS:
+            for row in data.get("rows", []):
+                ARCHIVE.append(dict(zip(ARCHIVE_FIELDS, row)))
+            return len(ARCHIVE)
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        print("archive index read error, rebuilding:", e)
+
+    for ws in spreadsheet.worksheets():
+        if not ws.title.startswith(ARCHIVE_PREFIX):
+            continue
+        hdrs = gs_row_values_safe(ws, 1)
+        for row in iter_sheet_rows(ws, len(hdrs)):
+            rec = dict(zip(hdrs, row))
+            uid = str(rec.get("UserID") or "").strip()
+            if uid.isdigit():
+                _archive_put(int(uid), rec, ws.title)
+    save_archive_index()
+    return len(ARCHIVE)
+
+def settled_at(rec: dict) -> Optional[datetime]:
+    """Дата «закрытия» строки: погашение или отписка (берём более позднюю). None — строка ещё активна."""
+    dates = [parse_iso(rec.get("DateRedeemed") or ""), parse_iso(rec.get("UnsubscribedAt") or "")]
+    dates = [d for d in dates if d]
+    return max(dates) if dates else None
+
+def _open_archive_ws(title: str, hdrs: List[str]):
+    try:
+        return spreadsheet.worksheet(title)
+    except gspread.WorksheetNotFound:
+        ws = spreadsheet.add_worksheet(title=title, rows=1000, cols=len(hdrs))
+        gs_append_row_safe(ws, hdrs)
+        return ws
+
+def _row_ranges(rows: List[int]) -> List[Tuple[int, int]]:
+    # [2,3,4,7,9,10] -> [(2,4),(7,7),(9,10)]
+    ranges: List[Tuple[int, int]] = []
+    for r in sorted(rows):
+        if ranges and ranges[-1][1] == r - 1:
+            ranges[-1] = (ranges[-1][0], r)
+        else:
+            ranges.append((r, r))
+    return ranges
+
+def archive_settled_rows(after_days: Optional[int] = None) -> Tuple[int, int]:
+    """
+    Переносит закрытые строки старше after_days из sheet1 в листы «Archive YYYY-MM» (месяц выдачи кода)
+    и удаляет их из sheet1. Порядок: запись в архив -> индекс на диск -> удаление, поэтому сбой
+    посередине не теряет строки (повторный запуск только доудалит уже заархивированные).
+    Учтите: погашенные, но не отписавшиеся пользователи после архивации не проверяются /subs_refresh.
+    Возвращает: (перенесено строк, затронуто листов архива)
+    """
+    global ARCHIVE_EPOCH
+    days = ARCHIVE_AFTER_DAYS if after_days is None else after_days
+    cutoff = datetime.now() - timedelta(days=days)
+
+    with SHEET_ROWS_LOCK:
+        # лист читаем кусками и держим в памяти только отобранные строки
+        hdrs = gs_row_values_safe(sheet, 1)
+        picked: List[int] = []
+        by_title: Dict[str, List[list]] = {}
+        to_index: List[Tuple[int, dict, str]] = []
+        for i, row in enumerate(iter_sheet_rows(sheet, len(hdrs)), start=2):
+            rec = dict(zip(hdrs, row))
+            done = settled_at(rec)
+            if not done or done > cutoff:
+                continue
+            month_dt = parse_iso(rec.get("DateIssued") or "") or done
+            title = f"{ARCHIVE_PREFIX}{month_dt:%Y-%m}"
+            uid = str(rec.get("UserID") or "").strip()
+            picked.append(i)
+            if uid.isdigit() and ARCHIVE.find_user(int(uid)) is not None:
+                continue  # уже в архиве после прерванного запуска — только удалить
+            by_title.setdefault(title, []).append(row)
+            if uid.isdigit():
+                to_index.append((int(uid), rec, title))
+
+        if not picked:
+            return 0, 0
+
+        for title, rows in by_title.items():
+            gs_append_rows_safe(_open_archive_ws(title, hdrs), rows)
+        for uid, rec, title in to_index:
+            _archive_put(uid, rec, title)
+        save_archive_index()
+
+        # снизу вверх, чтобы номера ещё не удалённых диапазонов не съезжали
+        deleted: Set[int] = set()
+        try:
+            for start, end in reversed(_row_ranges(picked)):
+                gs_delete_rows_safe(sheet, start, end)
+                deleted.update(range(start, end + 1))
+        finally:
+            # даже если удаление оборвалось на середине, часть строк уже ушла —
+            # зеркало собираем по тому, что реально осталось в листе
+            ARCHIVE_EPOCH += 1
+            try:
+                mirror_reload()
+            except Exception as e:
+                print("archive: re-read after delete failed, using known deletions:", e)
+                # зеркало совпадало с листом до удаления (с точностью до несверенных ручных правок):
+                # выкидываем удалённые строки, а пустые CRC заставят следующую сверку пройти все блоки
+                old = PROMO_MIRROR
+                mirror_rebuild(old.headers, (row for i, row in enumerate(old.rows(), start=2) if i not in deleted))
+                SYNC["crc"] = []
+            coord_log("reload", {})
+
+    return len(picked), len(by_title)
+
+def schedule_archive_job():
+    if ARCHIVE_INTERVAL_HOURS <= 0:
+        return
+
+    def _run():
+        try:
+            moved, sheets_n = archive_settled_rows()
+            if moved:
+                print(f"Archive: moved {moved} rows into {sheets_n} sheet(s)")
+        except Exception as e:
+            print("archive job error:", e)
+        schedule_archive_job()
+
+    t = Timer(ARCHIVE_INTERVAL_HOURS * 3600, _run)
+    t.daemon = True
+    t.start()
+
+load_archive_index()
+
+# ---------- Зеркало sheet1 и сверка с таблицей ----------
+RESYNC_BLOCK_ROWS = 500
+# больше изменившихся строк за одну сверку в памяти не держим — проще пересобрать зеркало целиком
+RESYNC_MAX_DELTA_ROWS = SHEET_READ_CHUNK
+# насколько часы Google и наши могут расходиться при сравнении modifiedTime со временем своей записи
+RESYNC_CLOCK_SLACK_SEC = 5
+# modified — последнее учтённое modifiedTime файла; crc — CRC блоков sheet1 на момент последнего чтения;
+# unread_since — с какого момента лист не читался, потому что modifiedTime двигали только записи бота;
+# journal — записи бота в зеркало, сделанные пока идёт сверка (None — сверки нет)
+SYNC: Dict[str, object] = {"modified": None, "crc": [], "unread_since": 0.0, "journal": None}
+RESYNC_LOCK = threading.Lock()  # сверки не пересекаются: у них общий SYNC["journal"]
+
+def _block_crc(rows: List[list]) -> int:
+    # пустые ячейки в конце строки не считаем: get по диапазону их обрезает, get_all_values дополняет
+    chunk = "\x1e".join("\x1f".join(r).rstrip("\x1f") for r in rows)
+    return zlib.crc32(chunk.encode("utf-8"))
+
+def _iter_blocks(rows):
+    block: List[list] = []
+    for row in rows:
+        block.append(row)
+        if len(block) == RESYNC_BLOCK_ROWS:
+            yield block
+            block = []
+    if block:
+        yield block
+
+def _crc_tee(rows, out: List[int]):
+    # отдаёт строки дальше как есть и по пути дописывает в out CRC блоков по RESYNC_BLOCK_ROWS строк
+    for block in _iter_blocks(rows):
+        out.append(_block_crc(block))
+        yield from block
+
+def mirror_rebuild(hdr: List[str], rows) -> None:
+    """Полная пересборка зеркала из заголовка листа и строк (список или потоковое чтение)."""
+    global PROMO_MIRROR
+    crcs: List[int] = []
+    PROMO_MIRROR = PromoStore.from_rows(hdr, _crc_tee(rows, crcs))
+    SYNC["crc"] = crcs
+
+def mirror_reload() -> None:
+    """Пересборка зеркала потоковым чтением sheet1 (см. iter_sheet_rows); заголовки — тоже из листа."""
+    hdr = gs_row_values_safe(sheet, 1)
+    mirror_rebuild(hdr, iter_sheet_rows(sheet, len(hdr)))
+    if hdr:
+        headers[:] = hdr
+
+def _apply_change(store: PromoStore, kind: str, p: dict) -> bool:
+    """Запись журнала зеркала (headers/append/update, как в coord_log) -> store. False — такой строки в store нет."""
+    if kind == "headers":
+        for h in p["headers"]:
+            store.add_column(h)
+    elif kind == "append":
+        i = p["row"] - 2
+        if i < len(store):
+            store.set_fields(i, p["rec"])
+        elif i == len(store):
+            store.append(p["rec"])
+        else:
+            return False
+    elif kind == "update":
+        for row_idx, fields in p["rows"].items():
+            i = int(row_idx) - 2
+            if i >= len(store):
+                return False
+            store.set_fields(i, fields)
+    return True
+
+def _sheet_modified_time() -> Optional[str]:
+    # modifiedTime из Drive — один лёгкий запрос метаданных вместо чтения всего листа
+    fn = getattr(spreadsheet, "get_lastUpdateTime", None)
+    if fn is None:
+        return None
+    try:
+        with GS_LOCK:
+            return _with_retries(fn)
+    except Exception as e:
+        print("lastUpdateTime error:", e)
+        return None
+
+def _modified_by_bot(modified: str) -> bool:
+    # modifiedTime в Drive — RFC 3339 в UTC: «2024-05-01T12:34:56.789Z»
+    try:
+        ts = datetime.fromisoformat(modified.replace("Z", "+00:00")).timestamp()
+    except ValueError:
+        return False
+    return ts <= own_write_at() + RESYNC_CLOCK_SLACK_SEC
+
+def reconcile_mirror(force: bool = False) -> Optional[int]:
+    """
+    Подтягивает в зеркало ручные правки sheet1.
+    Сначала дёшево сверяет modifiedTime файла: если он не менялся или его сдвинули записи самого бота,
+    лист не читается. Ручная правка, после которой бот успел что-то записать, так не видна — поэтому
+    без чтения проходит не больше RESYNC_FULL_CHECK_SEC подряд.
+    Лист читается кусками без SHEET_ROWS_LOCK (выдача кодов не ждёт), в памяти остаются только строки
+    блоков по RESYNC_BLOCK_ROWS, чей CRC изменился. Под lock они применяются к зеркалу, кроме ячеек,
+    которые бот записал уже после начала чтения (SYNC["journal"]): там зеркало новее прочитанного.
+    Если строки удалили, поменяли заголовки или правок слишком много — новое зеркало строится тем же
+    чтением вне lock, а под lock на него накатывается журнал, и оно подменяет старое.
+    Возвращает число применённых строк или None, если сверка не понадобилась/отложена.
+    """
+    modified = _sheet_modified_time()
+    now = datetime.now().timestamp()
+    if not force and modified is not None:
+        if modified != SYNC["modified"] and _modified_by_bot(modified):
+            SYNC["modified"] = modified
+            SYNC["unread_since"] = SYNC["unread_since"] or now
+        if modified == SYNC["modified"] and (not SYNC["unread_since"]
+                                             or now - SYNC["unread_since"] < RESYNC_FULL_CHECK_SEC):
+            return None
+    with RESYNC_LOCK:
+        return _reconcile(modified)
+
+def _reconcile(modified: Optional[str]) -> Optional[int]:
+    global PROMO_MIRROR, ARCHIVE_EPOCH
+    with SHEET_ROWS_LOCK:
+        epoch, n_before = ARCHIVE_EPOCH, len(PROMO_MIRROR)
+        SYNC["journal"] = []
+    try:
+        hdr = gs_row_values_safe(sheet, 1)
+        crcs: List[int] = []
+        blocks, store = None, None
+        if [h for h in hdr if h][:len(PROMO_MIRROR.headers)] == PROMO_MIRROR.headers:
+            crcs, blocks = _read_changed_blocks(hdr, n_before)
+        if blocks is None:
+            crcs = []
+            store = PromoStore.from_rows(hdr, _crc_tee(iter_sheet_rows(sheet, len(hdr)), crcs))
+
+        with SHEET_ROWS_LOCK:
+            journal = SYNC["journal"]
+            if ARCHIVE_EPOCH != epoch:
+                return None  # архивация/перечитка уже пересобрала зеркало по свежему листу
+            if store is not None and not _replay_journal(store, journal):
+                return None
+            SYNC["modified"], SYNC["unread_since"], SYNC["crc"] = modified, 0.0, crcs
+            if hdr:
+                headers[:] = hdr  # колонки, добавленные в лист вручную
+            if store is None:
+                return _apply_blocks(hdr, blocks, journal)
+            ARCHIVE_EPOCH += 1  # номера строк могли сдвинуться
+            PROMO_MIRROR = store
+            coord_log("reload", {})
+            return len(store)
+    finally:
+        SYNC["journal"] = None
+
+def _read_changed_blocks(hdr: List[str], n_before: int):
+    """
+    Потоковое чтение sheet1 для сверки: (CRC всех блоков, {номер блока: строки}) только для блоков
+    с изменившимся CRC. Блоки None — дельтой не применить: строк стало меньше, чем было в зеркале
+    (удалили вручную), или изменившихся строк больше RESYNC_MAX_DELTA_ROWS.
+    """
+    old, crcs, blocks = SYNC["crc"], [], {}
+    kept = n = 0
+    for b, block in enumerate(_iter_blocks(iter_sheet_rows(sheet, len(hdr)))):
+        crc = _block_crc(block)
+        crcs.append(crc)
+        n += len(block)
+        if b < len(old) and old[b] == crc:
+            continue
+        kept += len(block)
+        if kept > RESYNC_MAX_DELTA_ROWS:
+            return crcs, None
+        blocks[b] = block
+    return crcs, (blocks if n >= n_before else None)
+
+def _apply_blocks(hdr: List[str], blocks: Dict[int, List[list]], journal: list) -> int:
+    # ячейки, которые бот записал после начала чтения: в зеркале они новее прочитанного.
+    # Дописанные ботом строки не пропускаем — если чтение их захватило, они совпадут с зеркалом.
+    fresh: Dict[int, Set[str]] = {}
+    for kind, p in journal:
+        if kind == "update":
+            for row_idx, fields in p["rows"].items():
+                fresh.setdefault(int(row_idx) - 2, set()).update(fields)
+
+    store = PROMO_MIRROR
+    for h in hdr:
+        store.add_column(h)
+    changed = 0
+    for b, block in blocks.items():
+        for k, row in enumerate(block):
+            i = b * RESYNC_BLOCK_ROWS + k
+            rec = dict(zip(hdr, row))
+            if i >= len(store):
+                store.append(rec)
+                changed += 1
+                continue
+            # только отличающиеся ячейки: TextColumn дописывает каждое значение заново,
+            # а счётчики статистики пересчитываются лишь при правке их колонок
+            skip = fresh.get(i, ())
+            diff = {h: rec.get(h, "") for h in store.headers
+                    if h not in skip and store.get(i, h) != rec.get(h, "")}
+            if diff:
+                store.set_fields(i, diff)
+                changed += 1
+    return changed
+
+def _replay_journal(store: PromoStore, journal: list) -> bool:
+    # записи бота, сделанные во время чтения, — поверх нового зеркала. Дописанные строки ищем по UserID:
+    # чтение могло их уже захватить, а номер строки после ручного удаления строк у бота был неверный
+    for kind, p in journal:
+        if kind == "append":
+            uid = str(p["rec"].get("UserID") or "")
+            i = store.find_user(int(uid)) if uid.isdigit() else None
+            if i is None:
+                store.append(p["rec"])
+            else:
+                store.set_fields(i, p["rec"])
+        elif kind in ("headers", "update") and not _apply_change(store, kind, p):
+            return False
+    return True
+
+def schedule_resync_job():
+    if RESYNC_INTERVAL_SEC <= 0:
+        return
+
+    def _run():
+        try:
+            if COORD_DB_PATH:
+                with SHEET_ROWS_LOCK:
+                    pass  # захват lock сам догоняет записи других воркеров
+            changed = reconcile_mirror()
+            if changed:
+                print(f"Resync: applied {changed} changed row(s) from the sheet")
+        except Exception as e:
+            print("resync job error:", e)
+        schedule_resync_job()
+
+    t = Timer(RESYNC_INTERVAL_SEC, _run)
+    t.daemon = True
+    t.start()
+
+# ---------- Журнал изменений зеркала между воркерами ----------
+# Каждый воркер держит своё зеркало sheet1. Записи бота (строки, ячейки, новые колонки, погашения
+# в архиве, пересборки) кладутся в таблицу changes, и при захвате SHEET_ROWS_LOCK воркер применяет
+# чужие записи к своему зеркалу. Поэтому проверка «код уже погашен?» под lock видит погашения
+# из любого воркера. Применение идемпотентно: строка, которая уже есть в зеркале, просто перезаписывается.
+COORD_SEQ = 0            # последняя применённая запись changes
+COORD_KEEP_CHANGES = 20000
+
+def coord_log(kind: str, payload: dict) -> None:
+    if SYNC["journal"] is not None:
+        SYNC["journal"].append((kind, payload))  # идёт сверка — ей нужно знать, что бот записал
+    if not COORD_DB_PATH:
+        return
+    cur = coord_db().execute("INSERT INTO changes (pid, kind, payload) VALUES (?, ?, ?)",
+                             (os.getpid(), kind, json.dumps(payload, ensure_ascii=False)))
+    if cur.lastrowid % 1000 == 0:
+        coord_db().execute("DELETE FROM changes WHERE seq <= ?", (cur.lastrowid - COORD_KEEP_CHANGES,))
+
+def coord_last_seq() -> int:
+    if not COORD_DB_PATH:
+        return 0
+    return coord_db().execute("SELECT COALESCE(MAX(seq), 0) FROM changes").fetchone()[0]
+
+def coord_reload() -> None:
+    """Полная перечитка sheet1 и индекса архива — после чужой архивации/пересборки или пропуска в журнале."""
+    global ARCHIVE, ARCHIVE_EPOCH
+    ARCHIVE_EPOCH += 1
+    mirror_reload()
+    ARCHIVE = PromoStore(ARCHIVE_FIELDS)
+    load_archive_index()
+
+def coord_replay() -> None:
+    """Применяет к зеркалу записи других воркеров. Вызывается под SHEET_ROWS_LOCK."""
+    global COORD_SEQ
+    rows = coord_db().execute("SELECT seq, pid, kind, payload FROM changes WHERE seq > ? ORDER BY seq",
+                              (COORD_SEQ,)).fetchall()
+    if not rows:
+        return
+    gap = rows[0][0] != COORD_SEQ + 1  # старые записи уже удалены — дельтой не догнать
+    COORD_SEQ = rows[-1][0]
+    pid = os.getpid()
+    foreign = [(kind, json.loads(payload)) for _, p, kind, payload in rows if p != pid]
+    if not foreign and not gap:
+        return
+    if SYNC["journal"] is not None:
+        SYNC["journal"].extend(foreign)  # чужие записи для сверки те же, что свои
+    kinds = [kind for kind, _ in foreign]
+    if gap or "reload" in kinds:
+        coord_reload()
+        if "reload" in kinds:
+            foreign = foreign[len(kinds) - kinds[::-1].index("reload"):]
+    for kind, p in foreign:
+        if kind == "headers":
+            headers[:] = p["headers"]
+        if kind in ("headers", "append", "update"):
+            if not _apply_change(PROMO_MIRROR, kind, p):
+                coord_reload()
+        elif kind == "archive_redeemed":
+            i = ARCHIVE.find_code(p["code"])
+            if i is not None:
+                ARCHIVE.set_fields(i, {"DateRedeemed": p["when"]})
+
+# Зеркало sheet1 в памяти: поиск строк и статистика без get_all_records на каждый запрос.
+# COORD_SEQ берём до чтения листа: записи, попавшие между, применятся повторно (это безопасно).
+COORD_SEQ = coord_last_seq()
+mirror_reload()
+
 # ---------- Инлайн-меню статистики ----------
 CB_SUBS_MENU_CUR = "subs_menu_cur"
 CB_SUBS_MENU_PREV = "subs_menu_prev"
 CB_SUBS_MENU_ALL = "subs_menu_all"
 CB_SUBS_MENU_PICK = "subs_menu_pick"
 
-def send_subs_menu(chat_id: int):
+def _build_subs_menu_keyboard():
     kb = telebot.types.InlineKeyboardMarkup()
     kb.add(
         telebot.types.InlineKeyboardButton("🗓 Текущий месяц", callback_data=CB_SUBS_MENU_CUR),
@@ -625,7 +2145,12 @@ def send_subs_menu(chat_id: int):
         telebot.types.InlineKeyboardButton("📆 Выбрать месяц", callback_data=CB_SUBS_MENU_PICK),
         telebot.types.InlineKeyboardButton("∞ Всё время", callback_data=CB_SUBS_MENU_ALL),
     )
-    bot.send_message(chat_id, "Выберите период для статистики:", reply_markup=kb)
+    return kb
+
+SUBS_MENU_KEYBOARD = FrozenMarkup(_build_subs_menu_keyboard())
+
+def send_subs_menu(chat_id: int):
+    bot.send_message(chat_id, "Выберите период для статистики:", reply_markup=SUBS_MENU_KEYBOARD)
 
 # ---------- Статистика (меню/команды) ----------
 @bot.message_handler(func=lambda m: m.text == BTN_STATS_MENU)
@@ -671,9 +2196,11 @@ def cmd_subs_refresh(message):
     if not is_admin(message.from_user.id):
         bot.reply_to(message, "Доступно только администратору.")
         return
-    max_checks = None
-    checked, updated = refresh_unsubs(max_checks=max_checks)
-    bot.reply_to(message, f"Проверено: {checked}, обновлено UnsubscribedAt: {updated}")
+    def _work():
+        checked, updated = refresh_unsubs(max_checks=None)
+        return f"Проверено: {checked}, обновлено UnsubscribedAt: {updated}"
+
+    run_admin_job(message, "Проверка отписок", _work)
 
 @bot.callback_query_handler(func=lambda c: c.data in {CB_SUBS_MENU_CUR, CB_SUBS_MENU_PREV, CB_SUBS_MENU_ALL, CB_SUBS_MENU_PICK})
 def cb_subs_menu(cb):
@@ -683,30 +2210,310 @@ def cb_subs_menu(cb):
         except Exception: pass
         return
 
+    if cb.data == CB_SUBS_MENU_PICK:
+        try:
+            bot.answer_callback_query(cb.id)
+        except Exception:
+            pass
+        STATE[uid] = "await_month_pick"
+        bot.send_message(cb.message.chat.id, "Введите месяц в формате <b>YYYY-MM</b>, например <code>2025-08</code>.", parse_mode="HTML")
+        return
+
+    run_callback_in_background(cb, "⏳ Считаю статистику…", lambda: (subs_menu_stats_text(cb.data), None))
+
+def subs_menu_stats_text(data: str) -> str:
     now = datetime.now()
-    if cb.data == CB_SUBS_MENU_CUR:
+    if data == CB_SUBS_MENU_CUR:
         start_dt, end_dt = month_bounds(now.year, now.month)
         subs, unsubs = aggregate_by_source(period=(start_dt, end_dt))
-        text = format_stats_by_source(f"Подписки по источникам — {now.year}-{str(now.month).zfill(2)}", subs, unsubs)
-        bot.send_message(cb.message.chat.id, text)
-    elif cb.data == CB_SUBS_MENU_PREV:
+        return format_stats_by_source(f"Подписки по источникам — {now.year}-{str(now.month).zfill(2)}", subs, unsubs)
+    if data == CB_SUBS_MENU_PREV:
         prev_month = now.month - 1 or 12
         prev_year = now.year if now.month > 1 else now.year - 1
         start_dt, end_dt = month_bounds(prev_year, prev_month)
         subs, unsubs = aggregate_by_source(period=(start_dt, end_dt))
-        text = format_stats_by_source(f"Подписки по источникам — {prev_year}-{str(prev_month).zfill(2)}", subs, unsubs)
-        bot.send_message(cb.message.chat.id, text)
-    elif cb.data == CB_SUBS_MENU_ALL:
-        subs, unsubs = aggregate_by_source(period=None)
-        text = format_stats_by_source("Подписки по источникам — все время", subs, unsubs)
-        bot.send_message(cb.message.chat.id, text)
-    elif cb.data == CB_SUBS_MENU_PICK:
-        STATE[uid] = "await_month_pick"
-        bot.send_message(cb.message.chat.id, "Введите месяц в формате <b>YYYY-MM</b>, например <code>2025-08</code>.", parse_mode="HTML")
+        return format_stats_by_source(f"Подписки по источникам — {prev_year}-{str(prev_month).zfill(2)}", subs, unsubs)
+    subs, unsubs = aggregate_by_source(period=None)
+    return format_stats_by_source("Подписки по источникам — все время", subs, unsubs)
+
+@bot.message_handler(commands=["archive_run"])
+def cmd_archive_run(message):
+    if not is_admin(message.from_user.id):
+        bot.reply_to(message, "Доступно только администратору.")
+        return
+    parts = message.text.split(maxsplit=1)
+    days = None
+    if len(parts) > 1:
+        if not parts[1].strip().isdigit():
+            bot.reply_to(message, "Формат: /archive_run [дней] (например, /archive_run 60)")
+            return
+        days = int(parts[1].strip())
+    def _work():
+        moved, sheets_n = archive_settled_rows(after_days=days)
+        return f"Перенесено в архив строк: {moved}, листов архива: {sheets_n}"
+
+    run_admin_job(message, "Архивация", _work)
+
+@bot.message_handler(commands=["resync"])
+def cmd_resync(message):
+    if not is_admin(message.from_user.id):
+        bot.reply_to(message, "Доступно только администратору.")
+        return
+    parts = message.text.split(maxsplit=1)
+    full = len(parts) > 1 and parts[1].strip() == "full"
+
+    def _work():
+        if full:
+            with SHEET_ROWS_LOCK:
+                mirror_reload()
+                coord_log("reload", {})
+            return f"Зеркало пересобрано: строк {len(PROMO_MIRROR)}"
+        changed = reconcile_mirror(force=True)
+        return f"Сверка с таблицей: обновлено строк {changed or 0} (всего {len(PROMO_MIRROR)})"
+
+    run_admin_job(message, "Пересборка зеркала" if full else "Сверка с таблицей", _work)
+
+# ---------- Профилирование по запросу ----------
+# /profile подменяет выбранные функции в globals() обёртками с cProfile и возвращает оригиналы
+# после N вызовов или /profile off. /profile sample снимает стеки рабочих потоков раз в
+# PROFILE_SAMPLE_MS. Пока замер не запущен, ни обёрток, ни потока нет.
+PROFILE_TARGETS = ("issue_code", "redeem_code", "aggregate_by_source", "refresh_unsubs")
+PROFILE_SAMPLE_MS = 10
+PROFILE_LOCK = threading.Lock()
+PROFILE: Dict[str, object] = {"mode": None}
+_PROFILE_TLS = threading.local()  # вложенный вызов в том же потоке только замеряется по времени
+# куда относить время при разбивке: первая группа, чьё слово есть в пути файла/имени функции
+PROFILE_GROUPS = (
+    ("Google Sheets", ("gspread", "oauth2client")),
+    ("Telegram", ("telebot",)),
+    ("Сеть", ("requests", "urllib3", "http", "ssl", "socket")),
+    ("Бот", ("main.py",)),
+)
+
+def _profile_group(key: Tuple[str, int, str]) -> str:
+    where = f"{key[0]} {key[2]}"
+    for title, words in PROFILE_GROUPS:
+        if any(w in where for w in words):
+            return title
+    return "Прочее"
+
+def _profile_breakdown(st: pstats.Stats) -> Dict[str, float]:
+    """Собственное время функций (мс), сложенное по PROFILE_GROUPS."""
+    out: Dict[str, float] = {}
+    for key, (_, _, tt, _, _) in st.stats.items():
+        g = _profile_group(key)
+        out[g] = out.get(g, 0.0) + tt * 1000
+    return out
+
+def _format_breakdown(parts: Dict[str, float]) -> str:
+    text = ", ".join(f"{g} {ms:.0f} мс" for g, ms in sorted(parts.items(), key=lambda x: -x[1]) if ms >= 1)
+    return text or "всё < 1 мс"
+
+def _profiled(name: str, fn):
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        prof = None
+        if not getattr(_PROFILE_TLS, "active", False):
+            prof = cProfile.Profile()
+            try:
+                prof.enable()
+                _PROFILE_TLS.active = True
+            except ValueError:
+                prof = None  # Python 3.12+: в другом потоке уже работает профайлер
+        t0 = monotonic()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            ms = (monotonic() - t0) * 1000
+            if prof:
+                prof.disable()
+                _PROFILE_TLS.active = False
+            _profile_record(name, ms, prof)
+    return wrapper
+
+def _profile_record(name: str, ms: float, prof: Optional[cProfile.Profile]) -> None:
+    st = pstats.Stats(prof) if prof else None
+    with PROFILE_LOCK:
+        if PROFILE["mode"] != "cprofile":
+            return
+        t = PROFILE["timings"].setdefault(name, [0, 0.0, 0.0])  # вызовов, сумма мс, максимум мс
+        t[0] += 1
+        t[1] += ms
+        t[2] = max(t[2], ms)
+        if st:
+            if PROFILE["stats"] is None:
+                PROFILE["stats"] = st
+            else:
+                PROFILE["stats"].add(st)
+        if ms >= PROFILE_SLOW_MS and len(PROFILE["slow"]) < 50:
+            parts = _profile_breakdown(st) if st else {}
+            PROFILE["slow"].append((getattr(UPDATE_CTX, "update_id", None), name, ms, parts))
+        PROFILE["left"] -= 1
+        done = PROFILE["left"] <= 0
+    if done:
+        BG_POOL.submit(profile_finish)
+
+def profile_start(names: List[str], calls: int, chat_id: int) -> None:
+    with PROFILE_LOCK:
+        if PROFILE["mode"]:
+            raise RuntimeError("замер уже идёт — /profile off")
+        PROFILE.update(mode="cprofile", chat_id=chat_id, left=calls, stats=None, timings={}, slow=[],
+                       originals={}, started=monotonic())
+        for name in names:
+            PROFILE["originals"][name] = globals()[name]
+            globals()[name] = _profiled(name, globals()[name])
+
+def profile_finish() -> None:
+    with PROFILE_LOCK:
+        if PROFILE["mode"] != "cprofile":
+            return
+        for name, fn in PROFILE["originals"].items():
+            globals()[name] = fn
+        snap = dict(PROFILE)
+        PROFILE.clear()
+        PROFILE["mode"] = None
     try:
-        bot.answer_callback_query(cb.id)
-    except Exception:
-        pass
+        send_cprofile_report(snap)
+    except Exception as e:
+        print("profile report error:", e)
+
+def send_cprofile_report(snap: dict) -> None:
+    lines = [f"<b>Профиль за {monotonic() - snap['started']:.0f} с</b>"]
+    for name, (n, total, mx) in sorted(snap["timings"].items()):
+        lines.append(f"<code>{name}</code>: {n} выз., ср. {total / n:.0f} мс, макс. {mx:.0f} мс")
+    if not snap["timings"]:
+        lines.append("Выбранные функции не вызывались.")
+    st: Optional[pstats.Stats] = snap["stats"]
+    if st:
+        lines.append("Где ушло время: " + _format_breakdown(_profile_breakdown(st)))
+    if snap["slow"]:
+        lines.append(f"\nМедленные вызовы (≥ {PROFILE_SLOW_MS} мс):")
+        for update_id, name, ms, parts in snap["slow"][:10]:
+            lines.append(f"update {update_id}: <code>{name}</code> {ms:.0f} мс — {_format_breakdown(parts)}")
+    bot.send_message(snap["chat_id"], "\n".join(lines))
+    if not st:
+        return
+    out = io.StringIO()
+    st.stream = out
+    st.sort_stats("cumulative").print_stats(60)
+    for update_id, name, ms, parts in snap["slow"]:
+        out.write(f"slow: update {update_id} {name} {ms:.0f} ms — {_format_breakdown(parts)}\n")
+    bot.send_document(snap["chat_id"], io.BytesIO(out.getvalue().encode("utf-8")), visible_file_name="profile.txt")
+    path = f"/tmp/profile_{os.getpid()}.prof"
+    st.dump_stats(path)
+    with open(path, "rb") as f:
+        bot.send_document(snap["chat_id"], f, visible_file_name="profile.prof")
+
+def profile_sample(seconds: int, chat_id: int) -> None:
+    stop = threading.Event()
+    with PROFILE_LOCK:
+        if PROFILE["mode"]:
+            raise RuntimeError("замер уже идёт — /profile off")
+        PROFILE.update(mode="sample", stop=stop)
+
+    def _run():
+        me, main_tid = threading.get_ident(), threading.main_thread().ident
+        leaf: Dict[Tuple[str, int, str], int] = {}
+        incl: Dict[Tuple[str, int, str], int] = {}
+        ticks = busy = 0
+        deadline = monotonic() + seconds
+        while monotonic() < deadline and not stop.is_set():
+            ticks += 1
+            for tid, frame in sys._current_frames().items():
+                # главный поток — это цикл polling/сервер Flask, свой поток не считаем
+                if tid in (me, main_tid):
+                    continue
+                code = frame.f_code
+                if code.co_filename.endswith(("threading.py", "queue.py", "selectors.py")):
+                    continue  # поток простаивает в ожидании работы
+                busy += 1
+                key = (code.co_filename, code.co_firstlineno, code.co_name)
+                leaf[key] = leaf.get(key, 0) + 1
+                seen = set()
+                while frame is not None:
+                    c = frame.f_code
+                    k = (c.co_filename, c.co_firstlineno, c.co_name)
+                    if k not in seen:
+                        seen.add(k)
+                        incl[k] = incl.get(k, 0) + 1
+                    frame = frame.f_back
+            sleep(PROFILE_SAMPLE_MS / 1000)
+        with PROFILE_LOCK:
+            PROFILE.clear()
+            PROFILE["mode"] = None
+        try:
+            send_sample_report(chat_id, ticks, busy, leaf, incl)
+        except Exception as e:
+            print("profile report error:", e)
+
+    threading.Thread(target=_run, name="profile-sampler", daemon=True).start()
+
+def send_sample_report(chat_id: int, ticks: int, busy: int, leaf: dict, incl: dict) -> None:
+    def fmt(key, n):
+        return f"{key[2]} ({os.path.basename(key[0])}:{key[1]}) — {100 * n / busy:.1f}%"
+
+    lines = [f"<b>Сэмплирование: {ticks} срезов, занятых потоков в срезах: {busy}</b>"]
+    if busy:
+        groups: Dict[str, int] = {}
+        for key, n in leaf.items():
+            g = _profile_group(key)
+            groups[g] = groups.get(g, 0) + n
+        lines.append("Где ушло время: " + ", ".join(
+            f"{g} {100 * n / busy:.0f}%" for g, n in sorted(groups.items(), key=lambda x: -x[1])))
+        lines.append("\nЧаще всего на стеке:")
+        top = sorted(((k, n) for k, n in incl.items() if k[0].endswith("main.py")), key=lambda x: -x[1])
+        lines += [html.escape(fmt(k, n)) for k, n in top[:10]]
+    bot.send_message(chat_id, "\n".join(lines))
+    if busy:
+        text = "self:\n" + "\n".join(fmt(k, n) for k, n in sorted(leaf.items(), key=lambda x: -x[1])[:100])
+        text += "\n\ninclusive:\n" + "\n".join(fmt(k, n) for k, n in sorted(incl.items(), key=lambda x: -x[1])[:100])
+        bot.send_document(chat_id, io.BytesIO(text.encode("utf-8")), visible_file_name="samples.txt")
+
+@bot.message_handler(commands=["profile"])
+def cmd_profile(message):
+    if not is_admin(message.from_user.id):
+        bot.reply_to(message, "Доступно только администратору.")
+        return
+    args = message.text.split()[1:]
+    usage = (
+        "Формат:\n"
+        "/profile [функции через запятую|all] [N] — cProfile на следующие N вызовов (по умолчанию all 50)\n"
+        "/profile sample [сек] — сэмплирование рабочих потоков (по умолчанию 30 с)\n"
+        "/profile off — остановить и прислать отчёт\n"
+        f"Функции: {', '.join(PROFILE_TARGETS)}"
+    )
+    if args and args[0] == "off":
+        if PROFILE["mode"] == "sample":
+            PROFILE["stop"].set()
+        elif PROFILE["mode"] == "cprofile":
+            profile_finish()
+        else:
+            bot.reply_to(message, "Замер не запущен.")
+        return
+    try:
+        if args and args[0] == "sample":
+            seconds = int(args[1]) if len(args) > 1 else 30
+            if not 1 <= seconds <= 600:
+                raise ValueError
+            profile_sample(seconds, message.chat.id)
+            bot.reply_to(message, f"Сэмплирование на {seconds} с запущено.")
+            return
+        names = list(PROFILE_TARGETS)
+        if args and not args[0].isdigit():
+            if args[0] != "all":
+                names = [x.strip() for x in args[0].split(",") if x.strip()]
+            args = args[1:]
+        calls = int(args[0]) if args else 50
+        if calls < 1 or not names or any(n not in PROFILE_TARGETS for n in names):
+            raise ValueError
+        profile_start(names, calls, message.chat.id)
+    except ValueError:
+        bot.reply_to(message, usage)
+        return
+    except RuntimeError as e:
+        bot.reply_to(message, str(e))
+        return
+    bot.reply_to(message, f"cProfile включён для {', '.join(names)} на {calls} вызовов.")
 
 # ---------- Персонал / Админ ----------
 @bot.message_handler(func=lambda m: m.text == BTN_STAFF_VERIFY)
@@ -715,9 +2522,22 @@ def handle_staff_verify(message):
         bot.reply_to(message, "Доступно только сотрудникам.")
         return
     STATE[message.from_user.id] = "await_code"
-    kb = telebot.types.ReplyKeyboardMarkup(resize_keyboard=True)
-    kb.add(telebot.types.KeyboardButton(BTN_CANCEL))
-    bot.reply_to(message, "Введите промокод для проверки/погашения (4 символа) или нажмите «Отмена».", reply_markup=kb)
+    bot.reply_to(message, "Введите промокод для проверки/погашения или нажмите «Отмена».", reply_markup=cancel_keyboard())
+
+@bot.message_handler(func=lambda m: m.text == BTN_STAFF_BATCH)
+def handle_staff_batch(message):
+    if not is_staff(message.from_user.id):
+        bot.reply_to(message, "Доступно только сотрудникам.")
+        return
+    STATE[message.from_user.id] = "await_batch_codes"
+    bot.reply_to(
+        message,
+        f"Пришлите до {BATCH_MAX_CODES} кодов одним сообщением — через пробел, запятую или с новой строки.\n"
+        "Чтобы привязать номер заказа, пишите его через двоеточие: <code>ABC23X:10045</code>.\n"
+        "Режим остаётся включённым до «Отмена».",
+        parse_mode="HTML",
+        reply_markup=cancel_keyboard()
+    )
 
 @bot.message_handler(func=lambda m: m.text == BTN_ADMIN_ADD_STAFF)
 def handle_admin_add_staff(message):
@@ -725,12 +2545,10 @@ def handle_admin_add_staff(message):
         bot.reply_to(message, "Доступно только сотрудникам.")
         return
     STATE[message.from_user.id] = "await_staff_id"
-    kb = telebot.types.ReplyKeyboardMarkup(resize_keyboard=True)
-    kb.add(telebot.types.KeyboardButton(BTN_CANCEL))
     bot.reply_to(
         message,
         "Пришлите ID пользователя-сотрудника (цифрами), перешлите его сообщение или отправьте его контакт. Либо «Отмена».",
-        reply_markup=kb
+        reply_markup=cancel_keyboard()
     )
 
 @bot.message_handler(content_types=["contact"])
@@ -746,6 +2564,196 @@ def handle_contact(message):
     else:
         bot.reply_to(message, "Контакт не содержит user_id Telegram. Пришлите ID цифрами или перешлите сообщение.")
 
+# ---------- Журнал отзывов ----------
+# Отзыв сначала дописывается строкой JSON в локальный журнал (с fsync) — пользователь сразу получает ответ.
+# Фоновый таймер забирает ещё не выгруженный хвост журнала и отправляет его в Feedback одним append_rows.
+# Позиция выгрузки (offset) и агрегаты по оценкам лежат в одном файле FEEDBACK_STATS_PATH и пишутся атомарно,
+# поэтому после рестарта выгрузка продолжается с того же места. Если процесс упал между append_rows и
+# сохранением offset, пачка уйдёт в лист повторно — лучше дубль, чем потерянный отзыв.
+# При COORD_DB_PATH журнал общий для воркеров: под lock'ами offset и агрегаты перечитываются из файла
+FEEDBACK_LOCK = process_lock("feedback", on_acquire=lambda: _feedback_reload())        # запись в журнал / усечение
+FEEDBACK_FLUSH_LOCK = process_lock("feedback_flush", on_acquire=lambda: _feedback_reload())  # одна выгрузка за раз
+FEEDBACK_OFFSET = 0
+FEEDBACK_DAYS: Dict[str, List[int]] = {}  # "YYYY-MM-DD" -> [кол-во оценок 1..5]
+FEEDBACK_FAILS = 0
+
+def feedback_journal_append(row: list) -> None:
+    line = json.dumps(row, ensure_ascii=False) + "\n"
+    with FEEDBACK_LOCK:
+        with open(FEEDBACK_JOURNAL_PATH, "a", encoding="utf-8") as f:
+            f.write(line)
+            f.flush()
+            os.fsync(f.fileno())
+
+def _feedback_count(rating, date_str: str) -> None:
+    try:
+        r = int(str(rating).strip())
+    except ValueError:
+        return
+    if 1 <= r <= 5:
+        FEEDBACK_DAYS.setdefault(str(date_str)[:10], [0] * 5)[r - 1] += 1
+
+def save_feedback_stats() -> None:
+    data = {"offset": FEEDBACK_OFFSET, "days": FEEDBACK_DAYS}
+    tmp = f"{FEEDBACK_STATS_PATH}.{os.getpid()}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(data, f, separators=(",", ":"))
+    os.replace(tmp, FEEDBACK_STATS_PATH)
+
+def _feedback_reload() -> None:
+    # другой воркер мог выгрузить/усечь журнал — берём его offset и агрегаты
+    global FEEDBACK_OFFSET
+    try:
+        with open(FEEDBACK_STATS_PATH, encoding="utf-8") as f:
+            data = json.load(f)
+    except (FileNotFoundError, ValueError):
+        return
+    FEEDBACK_OFFSET = int(data.get("offset", 0))
+    FEEDBACK_DAYS.clear()
+    FEEDBACK_DAYS.update(data.get("days", {}))
+
+def load_feedback_stats() -> None:
+    """Читает offset и агрегаты; если файла нет — один раз считает агрегаты по листу Feedback."""
+    global FEEDBACK_OFFSET
+    try:
+        with open(FEEDBACK_STATS_PATH, encoding="utf-8") as f:
+            data = json.load(f)
+        FEEDBACK_OFFSET = int(data.get("offset", 0))
+        FEEDBACK_DAYS.update(data.get("days", {}))
+    except FileNotFoundError:
+        for rec in _rows_as_records(gs_get_all_values_safe(feedback_ws)):
+            _feedback_count(rec.get("Rating"), rec.get("Date", ""))
+        save_feedback_stats()
+    except Exception as e:
+        print("feedback stats read error:", e)
+    # журнал усекли, а новый offset записать не успели
+    if FEEDBACK_OFFSET > feedback_journal_size():
+        FEEDBACK_OFFSET = 0
+        save_feedback_stats()
+
+def feedback_journal_size() -> int:
+    try:
+        return os.path.getsize(FEEDBACK_JOURNAL_PATH)
+    except FileNotFoundError:
+        return 0
+
+def _read_journal_batch(offset: int) -> Tuple[List[list], int]:
+    """Возвращает до FEEDBACK_FLUSH_BATCH целых строк журнала после offset и новый offset."""
+    rows: List[list] = []
+    try:
+        f = open(FEEDBACK_JOURNAL_PATH, "rb")
+    except FileNotFoundError:
+        return rows, offset
+    with f:
+        f.seek(offset)
+        while len(rows) < FEEDBACK_FLUSH_BATCH:
+            raw = f.readline()
+            if not raw.endswith(b"\n"):
+                break  # конец файла или недописанная строка
+            offset += len(raw)
+            try:
+                rows.append(json.loads(raw.decode("utf-8")))
+            except ValueError:
+                print("feedback journal: skipping broken line at", offset - len(raw))
+    return rows, offset
+
+def flush_feedback_journal() -> int:
+    """Выгружает накопленные отзывы в лист Feedback. Возвращает число записанных строк."""
+    global FEEDBACK_OFFSET
+    sent = 0
+    with FEEDBACK_FLUSH_LOCK:
+        while True:
+            rows, new_offset = _read_journal_batch(FEEDBACK_OFFSET)
+            if new_offset == FEEDBACK_OFFSET:
+                break
+            if rows:
+                gs_append_rows_safe(feedback_ws, rows)
+            with FEEDBACK_LOCK:
+                for row in rows:
+                    _feedback_count(row[2], row[5])
+                FEEDBACK_OFFSET = new_offset
+                save_feedback_stats()
+                if FEEDBACK_OFFSET == feedback_journal_size():
+                    open(FEEDBACK_JOURNAL_PATH, "w").close()
+                    FEEDBACK_OFFSET = 0
+                    save_feedback_stats()
+            sent += len(rows)
+    return sent
+
+def feedback_pending() -> int:
+    with FEEDBACK_LOCK:
+        try:
+            with open(FEEDBACK_JOURNAL_PATH, "rb") as f:
+                f.seek(FEEDBACK_OFFSET)
+                return f.read().count(b"\n")
+        except FileNotFoundError:
+            return 0
+
+def schedule_feedback_flush():
+    # при ошибках Sheets пауза растёт вдвое, но не больше 5 минут
+    delay = min(FEEDBACK_FLUSH_SEC * (2 ** FEEDBACK_FAILS), 300)
+
+    def _run():
+        global FEEDBACK_FAILS
+        try:
+            flush_feedback_journal()
+            FEEDBACK_FAILS = 0
+        except Exception as e:
+            FEEDBACK_FAILS = min(FEEDBACK_FAILS + 1, 10)
+            print("feedback flush error:", e)
+        schedule_feedback_flush()
+
+    t = Timer(delay, _run)
+    t.daemon = True
+    t.start()
+
+def format_feedback_stats(days: int) -> str:
+    since = (datetime.now() - timedelta(days=days - 1)).strftime("%Y-%m-%d")
+    with FEEDBACK_LOCK:
+        per_day = sorted((d, list(c)) for d, c in FEEDBACK_DAYS.items() if d >= since)
+    totals = [sum(c[i] for _, c in per_day) for i in range(5)]
+    n = sum(totals)
+    lines = [f"<b>Отзывы за {days} дн.</b>"]
+    if not n:
+        lines.append("Оценок нет.")
+    else:
+        avg = sum((i + 1) * k for i, k in enumerate(totals)) / n
+        lines.append(f"Всего: <b>{n}</b>, средняя оценка: <b>{avg:.2f}</b>")
+        lines.append("По оценкам: " + ", ".join(f"{i + 1}⭐ — {k}" for i, k in enumerate(totals)))
+        lines.append("")
+        for d, c in per_day:
+            cnt = sum(c)
+            day_avg = sum((i + 1) * k for i, k in enumerate(c)) / cnt if cnt else 0
+            lines.append(f"{d}: {cnt} (ср. {day_avg:.2f})")
+    pending = feedback_pending()
+    if pending:
+        lines.append(f"\nЕщё не выгружено в таблицу: {pending}")
+    return "\n".join(lines)
+
+load_feedback_stats()
+
+@bot.message_handler(commands=["feedback_stats"])
+def cmd_feedback_stats(message):
+    if not is_staff(message.from_user.id):
+        bot.reply_to(message, "Доступно только сотрудникам.")
+        return
+    parts = message.text.split(maxsplit=1)
+    days = 7
+    if len(parts) > 1:
+        if not parts[1].strip().isdigit() or int(parts[1]) < 1:
+            bot.reply_to(message, "Формат: /feedback_stats [дней] (например, /feedback_stats 30)")
+            return
+        days = int(parts[1])
+    bot.reply_to(message, format_feedback_stats(days), parse_mode="HTML")
+
+@bot.message_handler(commands=["feedback_flush"])
+def cmd_feedback_flush(message):
+    if not is_admin(message.from_user.id):
+        bot.reply_to(message, "Доступно только администратору.")
+        return
+    run_admin_job(message, "Выгрузка отзывов",
+                  lambda: f"Выгружено отзывов в таблицу: {flush_feedback_journal()}")
+
 # ---------- Отзывы ----------
 @bot.message_handler(func=lambda m: m.text == BTN_FEEDBACK)
 def handle_feedback_start(message):
@@ -760,11 +2768,11 @@ def handle_feedback_rating(message):
     if STATE.get(uid) != "await_feedback_rating":
         return
     rating = int((message.text or "").split()[-1])
-    FEEDBACK_DRAFT[uid]["rating"] = rating
+    draft = FEEDBACK_DRAFT.get(uid, {"rating": None, "text": None, "photos": []})
+    draft["rating"] = rating
+    FEEDBACK_DRAFT[uid] = draft  # при COORD_DB_PATH черновик — копия, поэтому записываем обратно
     STATE[uid] = "await_feedback_text"
-    kb = telebot.types.ReplyKeyboardMarkup(resize_keyboard=True)
-    kb.add(telebot.types.KeyboardButton(BTN_CANCEL))
-    bot.reply_to(message, "Спасибо! Теперь напишите ваш отзыв одним сообщением.", reply_markup=kb)
+    bot.reply_to(message, "Спасибо! Теперь напишите ваш отзыв одним сообщением.", reply_markup=cancel_keyboard())
 
 @bot.message_handler(content_types=["photo"])
 def handle_photo(message):
@@ -772,9 +2780,11 @@ def handle_photo(message):
     if STATE.get(uid) != "await_feedback_photos":
         return
     file_id = message.photo[-1].file_id
-    photos: List[str] = FEEDBACK_DRAFT[uid]["photos"]
+    draft = FEEDBACK_DRAFT.get(uid, {"rating": None, "text": None, "photos": []})
+    photos: List[str] = draft["photos"]
     if len(photos) < 5:
         photos.append(file_id)
+        FEEDBACK_DRAFT[uid] = draft
         bot.reply_to(message, f"Фото добавлено ({len(photos)}/5).", reply_markup=photos_keyboard())
     else:
         bot.reply_to(message, "Можно прикрепить не более 5 фото.", reply_markup=photos_keyboard())
@@ -785,7 +2795,7 @@ def handle_feedback_submit_buttons(message):
     if STATE.get(uid) != "await_feedback_photos":
         return
     draft = FEEDBACK_DRAFT.get(uid, {})
-    gs_append_row_safe(feedback_ws, [
+    feedback_journal_append([
         str(uid),
         message.from_user.username or "",
         str(draft.get("rating")),
@@ -827,7 +2837,9 @@ def handle_text_general(message):
 
     if state == "await_feedback_text":
         text = (message.text or "").strip()
-        FEEDBACK_DRAFT[uid]["text"] = text
+        draft = FEEDBACK_DRAFT.get(uid, {"rating": None, "text": None, "photos": []})
+        draft["text"] = text
+        FEEDBACK_DRAFT[uid] = draft
         STATE[uid] = "await_feedback_photos"
         bot.reply_to(
             message,
@@ -857,20 +2869,77 @@ def handle_text_general(message):
         return
 
     if state == "await_code":
-        code = (message.text or "").strip().upper()
-        if len(code) != 4 or not all(ch in (string.ascii_uppercase + string.digits) for ch in code):
-            bot.reply_to(message, "Неверный формат. Введите 4 символа A–Z/0–9.")
+        code, error = validate_code(message.text)
+        if not code:
+            bot.reply_to(message, error, parse_mode="HTML")
             return
         ok, info = redeem_code(code, message.from_user.username or "Staff")
         STATE.pop(uid, None)
         bot.reply_to(message, info, parse_mode="HTML", reply_markup=make_main_keyboard(uid))
         return
 
+    if state == "await_batch_codes":
+        items = parse_batch(message.text)
+        if not items:
+            bot.reply_to(message, "Не нашёл ни одного кода. Пришлите коды через пробел или с новой строки.")
+            return
+        if len(items) > BATCH_MAX_CODES:
+            bot.reply_to(message, f"Слишком много кодов за раз: {len(items)}. Максимум — {BATCH_MAX_CODES}.")
+            return
+        results = redeem_codes_batch(items, message.from_user.username or "Staff")
+        bot.reply_to(message, format_batch_report(results), parse_mode="HTML")
+        return
+
     if message.text and message.text.startswith("/"):
         bot.reply_to(message, "Используйте кнопки снизу 👇", reply_markup=make_main_keyboard(uid))
     else:
         bot.reply_to(message, "Выберите действие на клавиатуре ниже 👇", reply_markup=make_main_keyboard(uid))
 
+# ---------- Диспетчер апдейтов (общий для webhook и polling) ----------
+ALLOWED_UPDATES = ["message", "callback_query", "chat_member"]
+
+def update_user_id(update) -> Optional[int]:
+    if update.message:
+        return update.message.from_user.id
+    if update.callback_query:
+        return update.callback_query.from_user.id
+    if update.chat_member:
+        return update.chat_member.new_chat_member.user.id
+    return None
+
+class UpdateDispatcher:
+    """
+    Апдейты раскладываются по очередям воркеров по user_id: у одного пользователя всё идёт строго
+    по порядку (состояние диалога не гоняется), разные пользователи обрабатываются параллельно.
+    """
+
+    def __init__(self, workers: int):
+        self.queues = [Queue() for _ in range(workers)]
+        for i, q in enumerate(self.queues):
+            threading.Thread(target=self._worker, args=(q,), name=f"dispatch-{i}", daemon=True).start()
+
+    def submit(self, updates: list, on_done=None) -> None:
+        """on_done(update_id) вызывается из воркера после обработки каждого апдейта (и при ошибке тоже)."""
+        for upd in updates:
+            uid = update_user_id(upd)
+            key = uid if uid is not None else upd.update_id
+            self.queues[key % len(self.queues)].put((upd, on_done))
+
+    def _worker(self, q: Queue) -> None:
+        while True:
+            upd, on_done = q.get()
+            UPDATE_CTX.update_id = upd.update_id
+            try:
+                with user_lock(update_user_id(upd)):
+                    bot.process_new_updates([upd])
+            except Exception as e:
+                print(f"Update {upd.update_id} error:", e)
+            finally:
+                if on_done:
+                    on_done(upd.update_id)
+
+DISPATCHER = UpdateDispatcher(DISPATCH_WORKERS)
+
 # ---------- FLASK (WEBHOOK/POLLING) ----------
 app = Flask(__name__)
 
@@ -892,16 +2961,19 @@ def telegram_webhook():
     try:
         json_str = request.get_data().decode("utf-8")
         update = telebot.types.Update.de_json(json_str)
-        bot.process_new_updates([update])
+        DISPATCHER.submit([update])
     except Exception as e:
         print("Webhook error:", e)
     return "OK", 200
 
+def set_webhook():
+    bot.remove_webhook()
+    bot.set_webhook(url=WEBHOOK_URL, allowed_updates=ALLOWED_UPDATES)
+    print("Webhook set to:", WEBHOOK_URL)
+
 def run_with_webhook():
     try:
-        bot.remove_webhook()
-        bot.set_webhook(url=WEBHOOK_URL, allowed_updates=["message","callback_query"])
-        print("Webhook set to:", WEBHOOK_URL)
+        set_webhook()
         port = int(os.getenv("PORT", "10000"))
         print("SBALO Promo Bot (Webhook) started on port", port)
         app.run(host="0.0.0.0", port=port)
@@ -910,16 +2982,75 @@ def run_with_webhook():
         run_with_polling()
 
 def run_with_polling():
+    """
+    getUpdates пачками до POLL_LIMIT в тот же диспетчер, что и webhook, не дожидаясь обработки.
+    offset подтверждает Telegram только апдейты до самого раннего необработанного: при падении
+    процесса недоделанные придут снова. Поэтому, пока что-то в работе, Telegram возвращает и уже
+    отданные в диспетчер апдейты — их пропускаем по update_id (он только растёт).
+    Если за одним застрявшим апдейтом накопится больше POLL_LIMIT новых, новые подождут его.
+    """
     print("Starting bot in long polling mode...")
     try:
         bot.remove_webhook()
     except Exception:
         pass
-    bot.infinity_polling(none_stop=True, timeout=60, long_polling_timeout=60)
+    lock = threading.Lock()
+    progress = threading.Event()
+    inflight: Set[int] = set()     # отданы в диспетчер, ещё не обработаны
+    next_id: Optional[int] = None  # всё, что меньше, уже отдано в диспетчер
+
+    def _done(update_id: int) -> None:
+        with lock:
+            inflight.discard(update_id)
+        progress.set()
+
+    errors = 0
+    while True:
+        progress.clear()
+        with lock:
+            offset = min(inflight) if inflight else next_id
+            busy = bool(inflight)
+        try:
+            # пока есть необработанные, Telegram ответит сразу (они ещё не подтверждены) — long poll не нужен
+            updates = bot.get_updates(offset=offset, limit=POLL_LIMIT, timeout=POLL_TIMEOUT + 10,
+                                      allowed_updates=ALLOWED_UPDATES,
+                                      long_polling_timeout=0 if busy else POLL_TIMEOUT)
+            errors = 0
+        except Exception as e:
+            errors += 1
+            print("Polling error:", e)
+            sleep(min(2 ** errors, 60))
+            continue
+        with lock:
+            fresh = [u for u in updates if next_id is None or u.update_id >= next_id]
+            inflight.update(u.update_id for u in fresh)
+            if updates:
+                next_id = max(next_id or 0, updates[-1].update_id + 1)
+        if fresh:
+            DISPATCHER.submit(fresh, on_done=_done)
+        elif busy:
+            # новых нет, ждём, пока что-то доделается (или немного, чтобы увидеть новые апдейты)
+            progress.wait(0.2)
+
+def start_background_jobs():
+    # сверку зеркала делает каждый воркер (у каждого своё зеркало), архивацию и выгрузку отзывов — только лидер
+    schedule_resync_job()
+    if coord_is_leader():
+        schedule_archive_job()
+        schedule_feedback_flush()
 
 if __name__ == "__main__":
+    start_background_jobs()
     if WEBHOOK_URL:
         run_with_webhook()
     else:
         print("BASE_URL is empty; falling back to polling.")
         run_with_polling()
+elif COORD_DB_PATH:
+    # Импорт воркером gunicorn (gunicorn -w N main:app, без --preload): webhook ставит лидер
+    start_background_jobs()
+    if WEBHOOK_URL and coord_is_leader():
+        try:
+            set_webhook()
+        except Exception as e:
+            print("Failed to set webhook:", e)